@@ -1,84 +1,97 @@
+import os
+import sys
 import time
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 
-import numpy as np
-from matplotlib import pyplot as plt
-from matplotlib.animation import FuncAnimation
-from matplotlib import animation
-from mpl_toolkits.mplot3d import Axes3D
-
-from logic_layer.task_planner import Module, State, find_path, trim_state
-from physical_layer.physical_layer import verify_pose, motion_planner
-from test import *
+from logic_layer.task_planner import Module, State, find_path, trim_state, use_headless_display
+from logic_layer.task_planner import DEFAULT_SEARCH_STRATEGY, DEFAULT_ASTAR_WEIGHT, DEFAULT_DISTANCE_HEURISTIC
+from logic_layer.task_planner import DEFAULT_BEAM_WIDTH, DEFAULT_BEAM_BRANCHING
+from logic_layer.task_planner import SEARCH_STRATEGIES, DISTANCE_HEURISTICS
+from logic_layer.move_filters import NogoodSet, UNREACHABLE_POSITION
+from logic_layer.planner_stats import PlannerStats, use_planner_stats
+from logic_layer.grid_state import convert_state, STATE_ENGINES, DEFAULT_STATE_ENGINE
+from physical_layer.physical_layer import motion_planner, solve_ik_batch, get_movement_positions
+from physical_layer.physical_layer import get_move_filters, PhysicalFailure
+from physical_layer.reachability_map import get_reachability_map
+import benchmark
+from video import create_reconfiguration_video, VIDEO_FORMATS, DEFAULT_VIDEO_FORMAT
 
 # This program implements a simple Task and Motion Planner (TAMP) for the reconfiguration
 # of modular blocks from a starting configuration to a goal configuration, under the physical
 # constraints presented by a mobile manipulator rearranging modules on a desk
-
-VIDEO_SAVE_LOCATION = __file__+"/../videos/"
-VIDEO_FRAME_INTERVAL = 1000
+# matplotlib, ikpy and the test configurations are imported on first use, so planning-only runs start quickly
 
 STATIONARY_ARM_POSITION = [0.1, -0.3, 0]
 MAX_PHYSICAL_LAYER_FAILURES = 500
 
 
-# Create and save a video of a transition path
-def create_reconfiguration_video(transition_path, label = "temp"):
-    # find required frame size
-    size = 0
-    for state in transition_path:
-        if state.size() > size:
-            size = state.size()
-    
-    # Create figure
-    fig = plt.figure(1)
-    ax = plt.axes(111, projection = '3d')
-    ax.set_title(label)
-    ax.axis("off")
-    
-    # Create frames
-    num_frames = len(transition_path)
-    def update(frame):
-        # Reset axis
-        ax.clear()
-        ax.set_title("Reconfiguration Video")
-        ax.axis("off")
-        
-        # set the colors of each object
-        current_state = transition_path[frame]
-        colour_mask = current_state.create_colour_mask(size)
-        
-        container = ax.voxels(colour_mask,
-                                facecolors = colour_mask,
-                                edgecolors = 'k',
-                                linewidth = 0.5)
-        
-        return container
-    
-    # Save Video
-    ani = FuncAnimation(fig = fig, func = update, frames = num_frames, interval = VIDEO_FRAME_INTERVAL)
-    ani.save(filename = VIDEO_SAVE_LOCATION + label + "/video.html", writer = "html")
-    
-    
 # Verify each start/end movement position in a transition path is reachable
-def verify_inverse_kinematics(transition_path):
+# All positions are solved in one batch, in worker processes if workers > 1
+# Returns (PhysicalFailure of the first unreachable position or 0, inverse kinematics solutions for each position)
+def verify_inverse_kinematics(transition_path, workers = 1):
+    ik_solutions = solve_ik_batch(STATIONARY_ARM_POSITION, get_movement_positions(transition_path), workers)
+    
     for state in transition_path:
         # if not start state
         if (state.birth_movement != 0):
-            # get start/end positions in metres
-            movement_decimetres = state.birth_movement
-            movement_metres = np.divide(movement_decimetres, 10) # Convert to metres
-            
-            for pos in movement_metres:
+            for pos in state.birth_movement:
                 # verify arm can reach position
-                if not verify_pose(STATIONARY_ARM_POSITION, pos):
-                    return state
-    return 0
+                if not ik_solutions[tuple(int(x) for x in pos)][0]:
+                    return PhysicalFailure(state, UNREACHABLE_POSITION, pos), ik_solutions
+    return 0, ik_solutions
 
 
 # Generate a transition plan to reconfigure s_start into s_goal
-def run_tamp_planner(s_start, s_goal):
+# strategy and weight select the logic layer search ordering (see task_planner.SEARCH_STRATEGIES)
+# heuristic selects the logic layer goal distance measure (see task_planner.DISTANCE_HEURISTICS)
+# workers > 1 runs logic layer state expansion (forward search only) and IK solves in parallel worker processes
+# move_filters are the move constraints applied by the logic layer, by default the physical constraints
+# of the stationary arm so physically infeasible moves are never planned
+# Physical layer failures are learned as nogoods, so later searches never repeat a failed movement
+# bidirectional searches the logic layer from both s_start and s_goal
+# time_budget (seconds) bounds the whole planner and max_expansions bounds each logic layer search,
+# the logic layer then keeps the shortest plan found within the budget (see task_planner.find_path_anytime)
+# beam_width and beam_branching configure the "beam" strategy (see task_planner.find_path_beam)
+# stats is the PlannerStats receiving counts and phase times of the run, created if None
+# progress_callback is called with the stats every progress_interval logic layer state expansions
+# translation_invariant accepts the goal structure built at any position (see task_planner.find_path)
+# state_engine selects how the logic layer stores configurations (see grid_state.STATE_ENGINES),
+# s_start and s_goal are converted to it and the transition path holds states of the engine
+# Returns (instruction set, transition path, stats), the instruction set and transition path are 0 if no plan was found
+def run_tamp_planner(s_start, s_goal, strategy = DEFAULT_SEARCH_STRATEGY, weight = DEFAULT_ASTAR_WEIGHT,
+                     heuristic = DEFAULT_DISTANCE_HEURISTIC, workers = 1, move_filters = None, bidirectional = False,
+                     time_budget = None, max_expansions = None, beam_width = DEFAULT_BEAM_WIDTH,
+                     beam_branching = DEFAULT_BEAM_BRANCHING, stats = None, progress_callback = None,
+                     translation_invariant = False, state_engine = DEFAULT_STATE_ENGINE):
+    s_start = convert_state(s_start, state_engine)
+    s_goal = convert_state(s_goal, state_engine)
+    if stats == None:
+        stats = PlannerStats(progress_callback)
+    previous_stats = use_planner_stats(stats)
+    try:
+        instruction_set, transition_path = plan_reconfiguration(
+            s_start, s_goal, strategy = strategy, weight = weight, heuristic = heuristic, workers = workers,
+            move_filters = move_filters, bidirectional = bidirectional, time_budget = time_budget,
+            max_expansions = max_expansions, beam_width = beam_width, beam_branching = beam_branching,
+            stats = stats, translation_invariant = translation_invariant)
+    finally:
+        use_planner_stats(previous_stats)
+    return instruction_set, transition_path, stats
+
+
+# Planning loop of run_tamp_planner, counting and timing into the active stats
+def plan_reconfiguration(s_start, s_goal, strategy, weight, heuristic, workers, move_filters, bidirectional,
+                         time_budget, max_expansions, beam_width, beam_branching, stats, translation_invariant):
     logic_time = 0
     physical_time = 0
+    start_time = time.time()
+    
+    if move_filters == None:
+        move_filters = get_move_filters(STATIONARY_ARM_POSITION)
+    nogoods = NogoodSet()
+    move_filters = list(move_filters) + [nogoods]
     
     # Find semantic solution
     search_tree = None
@@ -86,51 +99,59 @@ def run_tamp_planner(s_start, s_goal):
     while True:
         ##### Logic Layer #####
         t0 = time.time()
-        transition_path, search_tree = find_path(s_start, s_goal, search_tree)
+        remaining_time = None
+        if time_budget != None:
+            remaining_time = max(time_budget - (t0 - start_time), 0)
+        with stats.time_phase("logic"):
+            transition_path, search_tree = find_path(
+                s_start, s_goal, search_tree, strategy = strategy, weight = weight, heuristic = heuristic,
+                workers = workers, move_filters = move_filters, bidirectional = bidirectional,
+                time_budget = remaining_time, max_expansions = max_expansions, beam_width = beam_width,
+                beam_branching = beam_branching, stats = stats, translation_invariant = translation_invariant)
         logic_time += time.time() - t0
         
-        # If logic layer failed, no solution
-        if (transition_path == 0):
+        # If logic layer failed or ran out of budget before reaching the goal, no solution
+        if (transition_path == 0) or (not is_goal_reached(transition_path[-1], s_goal, translation_invariant)):
             print_invalid_sol(s_start.get_num_modules(), logic_time, physical_time)
             return 0, 0
         
         ##### Physical Layer #####
         t1 = time.time()
+        with stats.time_phase("physical"):
+            # verify inverse kinematics
+            failure, ik_solutions = verify_inverse_kinematics(transition_path, workers)
+            
+            # create motion plan
+            if (failure == 0):
+                instruction_set, failure = motion_planner(transition_path, ik_solutions)
+        physical_time += time.time() - t1
         
-        # verify inverse kinematics
-        failed_state = verify_inverse_kinematics(transition_path)
-        
-        # If IK failed, remove failed state and continue search
-        if (failed_state != 0):
-            if failure_count > MAX_PHYSICAL_LAYER_FAILURES:
-                print_invalid_sol(s_start.get_num_modules(), logic_time, physical_time)
-                return 0, 0
-            trim_state(failed_state, search_tree)
-            failure_count += 1
-            physical_time += time.time() - t1
-            continue
-    
-        # create motion plan
-        instruction_set, failed_state = motion_planner(transition_path)
-        
-        # If motion plan failed, remove failed state and continue search
-        if (failed_state != 0):
+        # If physical layer failed, record nogood, remove failed state and continue search
+        if (failure != 0):
+            stats.count("physical_failures")
             if failure_count > MAX_PHYSICAL_LAYER_FAILURES:
                 print_invalid_sol(s_start.get_num_modules(), logic_time, physical_time)
                 return 0, 0
-            trim_state(failed_state, search_tree)
+            nogoods.add(failure.reason, failure.position)
+            search_tree = trim_state(failure.state, search_tree)
             failure_count += 1
-            physical_time += time.time() - t1
             continue
         else:
             # If motion plan successful
-            physical_time += time.time() - t1
             break
-            
+    
+    stats.plan_length = len(transition_path) - 1
     print_valid_sol(str(len(transition_path) - 1), failure_count, logic_time, physical_time)
     return instruction_set, transition_path
 
 
+# Return True if a state is the goal state, or any translation of it if translation_invariant
+def is_goal_reached(state, s_goal, translation_invariant = False):
+    if translation_invariant:
+        return state.equals_translation(s_goal)
+    return state.equals(s_goal)
+
+
 # Print Solution Found
 def print_valid_sol(moves, failure_count, logic_t, physical_t):
         print("----- Solution Found -----")
@@ -140,6 +161,12 @@ def print_valid_sol(moves, failure_count, logic_t, physical_t):
         print("TIME: Physical Layer time -", physical_t, "s")
 
 
+# Print logic layer search progress, used as a PlannerStats progress callback
+def print_planning_progress(stats):
+    print("PROGRESS: states expanded -", stats.get_count("states_expanded"),
+          "| generated -", stats.get_count("states_generated"))
+
+
 # Print No Solution Found  
 def print_invalid_sol(num_modules, logic_time, physical_time):
         print("----- NO Solution Found -----")
@@ -148,12 +175,183 @@ def print_invalid_sol(num_modules, logic_time, physical_time):
         print("TIME: Physical Layer time -", physical_time, "s")
     
     
+# Skip state figures and use the non-interactive matplotlib backend for videos
+# MPLBACKEND is inherited by worker processes, so none of them load a GUI backend
+def use_headless_mode():
+    os.environ["MPLBACKEND"] = "Agg"
+    use_headless_display()
+
+
+# Set up a batch planning worker process
+# Figures are never shown and the reachability map saved by the batch process is memory-mapped
+def init_batch_worker():
+    use_headless_mode()
+    get_reachability_map(STATIONARY_ARM_POSITION, build = False)
+
+
+# Plan one (s_start, s_goal, label) problem of a batch with run_tamp_planner
+# Returns a picklable dictionary of the problem label, instruction set, movements, planning time and
+# planner stats (see PlannerStats.to_dict)
+def plan_batch_problem(problem, planner_options):
+    s_start, s_goal, label = problem
+    t0 = time.time()
+    instruction_set, transition_path, stats = run_tamp_planner(s_start, s_goal, **planner_options)
+    
+    result = {"label": label, "solved": transition_path != 0, "time": time.time() - t0,
+              "moves": 0, "movements": [], "instruction_set": instruction_set, "stats": stats.to_dict()}
+    if transition_path != 0:
+        result["moves"] = len(transition_path) - 1
+        result["movements"] = [[[int(x) for x in pos] for pos in state.birth_movement]
+                               for state in transition_path[1:]]
+    return result
+
+
+# Plan a list of (s_start, s_goal, label) problems, in worker processes if workers > 1
+# planner_options are keyword arguments of run_tamp_planner used for every problem
+# The reachability map is built once and shared by every worker through the saved map files
+# Returns (list of problem results in input order, batch statistics)
+def run_batch_planner(problems, workers = 1, planner_options = None):
+    if planner_options == None:
+        planner_options = dict()
+    use_headless_mode()
+    get_reachability_map(STATIONARY_ARM_POSITION, workers)
+    
+    t0 = time.time()
+    if workers > 1 and len(problems) > 1:
+        with ProcessPoolExecutor(max_workers = workers, initializer = init_batch_worker) as executor:
+            results = list(executor.map(plan_batch_problem, problems, [planner_options] * len(problems)))
+    else:
+        results = [plan_batch_problem(problem, planner_options) for problem in problems]
+    
+    stats = {"problems": len(problems),
+             "solved": sum([result["solved"] for result in results]),
+             "wall_time": time.time() - t0,
+             "planning_time": sum([result["time"] for result in results])}
+    return results, stats
+
+
+# Print per-problem results and statistics of a batch
+def print_batch_results(results, stats):
+    print("----- Batch Results -----")
+    for result in results:
+        status = str(result["moves"]) + " moves" if result["solved"] else "NO solution"
+        print(result["label"], "-", status, "-", round(result["time"], 3), "s",
+              "| logic", round(result["stats"].get("logic_time", 0), 3), "s",
+              "| physical", round(result["stats"].get("physical_time", 0), 3), "s",
+              "| expanded", result["stats"]["states_expanded"])
+    print("COUNT: Solved             -", stats["solved"], "/", stats["problems"])
+    print("TIME: Batch wall time     -", stats["wall_time"], "s")
+    print("TIME: Total planning time -", stats["planning_time"], "s")
+
+
+# Return True if config_name is a test configuration in test.py
+def is_test_problem(config_name):
+    import test
+    return callable(getattr(test, config_name, None))
+
+
+# Return the (s_start, s_goal, label) problem of a test configuration in test.py
+def get_test_problem(config_name):
+    import test
+    return getattr(test, config_name)()
+
+
 def main():
+    parser = argparse.ArgumentParser(description = "Plan modular block reconfigurations with a mobile manipulator")
+    subparsers = parser.add_subparsers(dest = "command")
+    run_parser = subparsers.add_parser("run", help = "plan one test configuration and save its video")
+    run_parser.add_argument("config", nargs = "?", default = "six_mod_config", help = "test.py configuration")
+    run_parser.add_argument("--stats", action = "store_true", help = "print planner counts, progress and phase times")
+    run_parser.add_argument("--headless", action = "store_true", help = "skip configuration figures")
+    run_parser.add_argument("--video-format", choices = VIDEO_FORMATS, default = DEFAULT_VIDEO_FORMAT)
+    run_parser.add_argument("--render-workers", type = int, default = 1, help = "video frame rendering processes")
+    batch_parser = subparsers.add_parser("batch", help = "plan several test configurations in parallel")
+    batch_parser.add_argument("configs", nargs = "+", help = "test.py configurations")
+    batch_parser.add_argument("--workers", type = int, default = 1, help = "planning worker processes")
+    batch_parser.add_argument("--output", help = "save results as JSON to this file")
+    benchmark_parser = subparsers.add_parser("benchmark", help = "benchmark the planner headlessly")
+    benchmark_parser.add_argument("configs", nargs = "*", default = benchmark.DEFAULT_BENCHMARK_SCENARIOS,
+                                  help = "test.py configurations")
+    benchmark_parser.add_argument("--random", type = int, default = 0, help = "number of random problems")
+    benchmark_parser.add_argument("--random-modules", type = int, default = 8, help = "modules per random problem")
+    benchmark_parser.add_argument("--seed", type = int, default = 0, help = "seed of the first random problem")
+    benchmark_parser.add_argument("--repeat", type = int, default = 1, help = "timed runs per scenario")
+    benchmark_parser.add_argument("--no-memory", action = "store_true", help = "skip peak memory measurement")
+    benchmark_parser.add_argument("--time-budget", type = float, help = "planner time budget per scenario (s)")
+    benchmark_parser.add_argument("--output", help = "save results as JSON to this file")
+    benchmark_parser.add_argument("--baseline", help = "JSON results to compare against")
+    benchmark_parser.add_argument("--tolerance", type = float, default = benchmark.DEFAULT_REGRESSION_TOLERANCE,
+                                  help = "relative increase over the baseline flagged as a regression")
+    for subparser in [run_parser, benchmark_parser]:
+        subparser.add_argument("--map-workers", type = int, default = 1,
+                               help = "processes building the reachability map on first run (~5000 IK solves, " +
+                                      "about 2.5 min on one process)")
+    for subparser in [run_parser, batch_parser, benchmark_parser]:
+        subparser.add_argument("--strategy", choices = SEARCH_STRATEGIES, default = DEFAULT_SEARCH_STRATEGY)
+        subparser.add_argument("--heuristic", choices = DISTANCE_HEURISTICS, default = DEFAULT_DISTANCE_HEURISTIC)
+        subparser.add_argument("--translation-invariant", action = "store_true",
+                               help = "accept the goal structure at any position")
+        subparser.add_argument("--state-engine", choices = STATE_ENGINES, default = DEFAULT_STATE_ENGINE,
+                               help = "logic layer configuration storage")
+    args = parser.parse_args()
+    
+    for config_name in getattr(args, "configs", [getattr(args, "config", "six_mod_config")]):
+        if not is_test_problem(config_name):
+            parser.error("unknown test configuration: " + config_name)
+    planner_options = {"strategy": getattr(args, "strategy", DEFAULT_SEARCH_STRATEGY),
+                       "heuristic": getattr(args, "heuristic", DEFAULT_DISTANCE_HEURISTIC),
+                       "state_engine": getattr(args, "state_engine", DEFAULT_STATE_ENGINE)}
+    if getattr(args, "translation_invariant", False):
+        planner_options["translation_invariant"] = True
+    
+    if args.command == "benchmark":
+        use_headless_mode()
+        get_reachability_map(STATIONARY_ARM_POSITION, args.map_workers)
+        problems = [benchmark.get_test_scenario(config_name) for config_name in args.configs]
+        problems += [benchmark.create_random_scenario(args.random_modules, args.seed + i) for i in range(args.random)]
+        if args.time_budget != None:
+            planner_options["time_budget"] = args.time_budget
+        
+        results = benchmark.run_benchmark(run_tamp_planner, problems, planner_options, args.repeat, not args.no_memory)
+        if args.output:
+            benchmark.save_benchmark_results(results, args.output)
+        if args.baseline:
+            regressions = benchmark.compare_to_baseline(results, benchmark.load_benchmark_results(args.baseline),
+                                                        args.tolerance)
+            for regression in regressions:
+                print("REGRESSION:", regression)
+            print("COUNT: Regressions        -", len(regressions))
+            if len(regressions):
+                sys.exit(1)
+        return
+    
+    if args.command == "batch":
+        use_headless_mode()
+        problems = [get_test_problem(config_name) for config_name in args.configs]
+        results, stats = run_batch_planner(problems, args.workers, planner_options)
+        print_batch_results(results, stats)
+        if args.output:
+            with open(args.output, "w") as output_file:
+                json.dump({"results": results, "stats": stats}, output_file, indent = 1)
+        return
+    
     # Get test configurations
-    s_start, s_goal, label = six_mod_config()
+    if getattr(args, "headless", False):
+        use_headless_mode()
+    s_start, s_goal, label = get_test_problem(getattr(args, "config", "six_mod_config"))
+    
+    # Load precomputed arm reachability, built and saved on first run (a one-time cost of about
+    # 5000 IK solves, spread over --map-workers processes)
+    get_reachability_map(STATIONARY_ARM_POSITION, getattr(args, "map_workers", 1))
     
     # Run system
-    instruction_set, transition_path = run_tamp_planner(s_start, s_goal)  
+    progress_callback = print_planning_progress if getattr(args, "stats", False) else None
+    instruction_set, transition_path, stats = run_tamp_planner(s_start, s_goal, progress_callback = progress_callback,
+                                                               **planner_options)
+    if getattr(args, "stats", False):
+        print(stats)
+    if transition_path == 0:
+        return
             
     # Display Output
     print("---------------------------------------------------------------------------")
@@ -164,7 +362,8 @@ def main():
     
     # Save video
     print("Video Name: " + label + " - " + str(len(transition_path) - 1) + " Moves")
-    create_reconfiguration_video(transition_path, label + " - " + str(len(transition_path) - 1) + " Moves")
+    create_reconfiguration_video(transition_path, label + " - " + str(len(transition_path) - 1) + " Moves",
+                                 getattr(args, "video_format", DEFAULT_VIDEO_FORMAT), getattr(args, "render_workers", 1))
     print("Video Generated with", str(len(transition_path) - 1), "moves!")
    
 
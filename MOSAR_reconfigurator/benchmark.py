@@ -0,0 +1,182 @@
+import io
+import sys
+import json
+import time
+import random
+import platform
+import tracemalloc
+from contextlib import redirect_stdout
+
+from logic_layer.task_planner import Module, State, use_headless_display
+from logic_layer.planner_stats import PlannerStats
+
+
+# This program details a headless benchmark of the Task and Motion Planner over the test.py configurations
+# and random reconfiguration problems, recording planning metrics as JSON and comparing them to a baseline
+# so performance regressions can be flagged
+
+
+# test3 and test4 are left out of the default scenarios
+# test3 is infeasible, its goal places modules 1.2 m from the arm, beyond its ~0.96 m reach
+# test4 exhausts the default searches, it is only solved by a narrow beam search
+# (find_path(..., strategy = "beam", beam_width = 8, beam_branching = 3), ~25-45 s)
+DEFAULT_BENCHMARK_SCENARIOS = ["four_mod_config", "five_mod_config", "six_mod_config", "seven_mod_config",
+                               "eight_mod_config", "nine_mod_config", "test2"]
+
+# Random problem settings
+RANDOM_PROBLEM_FOOTPRINT = 5        # modules are placed in a footprint x footprint area next to the arm
+RANDOM_PROBLEM_MAX_HEIGHT = 2
+RANDOM_PROBLEM_COLOURS = [[1, 0, 0], [0.5, 0.5, 0.5], [1, 1, 1]]
+
+# Regression thresholds, a metric regresses if it exceeds the baseline by the tolerance and the minimum change
+DEFAULT_REGRESSION_TOLERANCE = 0.25
+REGRESSION_MINIMUM_CHANGES = {"logic_time": 0.05, "physical_time": 0.05, "total_time": 0.05,
+                              "states_expanded": 10, "peak_memory": 1000000}
+
+
+# Return the (s_start, s_goal, name) problem of a test.py configuration
+# Configuration figures are skipped so their displays do not block
+def get_test_scenario(config_name):
+    import test
+    use_headless_display()
+    s_start, s_goal, label = getattr(test, config_name)()
+    return s_start, s_goal, config_name
+
+
+# Create a random connected configuration of modules resting on the desk or on other modules
+def create_random_state(rng, modules):
+    state = State()
+    positions = [(0, 0, 0)]
+    state.insert(positions[0], modules[0])
+
+    for module in modules[1:]:
+        # positions adjacent to the structure, inside the footprint and supported from below
+        candidates = []
+        for pos in positions:
+            for adj_pos in State.get_adjacent_positions(pos):
+                if ((adj_pos not in positions) and (adj_pos not in candidates) and
+                    0 <= adj_pos[0] < RANDOM_PROBLEM_FOOTPRINT and 0 <= adj_pos[1] < RANDOM_PROBLEM_FOOTPRINT and
+                    0 <= adj_pos[2] < RANDOM_PROBLEM_MAX_HEIGHT and
+                    (adj_pos[2] == 0 or (adj_pos[0], adj_pos[1], adj_pos[2] - 1) in positions)):
+                    candidates.append(adj_pos)
+
+        position = rng.choice(candidates)
+        positions.append(position)
+        state.insert(position, module)
+    return state
+
+
+# Create a random (s_start, s_goal, name) problem of num_modules modules, reproducible from the seed
+def create_random_scenario(num_modules, seed):
+    rng = random.Random(seed)
+    colours = [rng.choice(RANDOM_PROBLEM_COLOURS) for i in range(num_modules)]
+    s_start = create_random_state(rng, [Module(colour) for colour in colours])
+
+    rng.shuffle(colours)
+    s_goal = create_random_state(rng, [Module(colour) for colour in colours])
+    return s_start, s_goal, "random_" + str(num_modules) + "_" + str(seed)
+
+
+# Run a planner once on a problem, returning the planner stats (see PlannerStats.to_dict) and total time
+# Planner output is suppressed, peak memory is traced if measure_memory is True
+def run_scenario_once(planner, problem, planner_options, measure_memory = False):
+    s_start, s_goal, name = problem
+    planner_stats = PlannerStats()
+
+    if measure_memory:
+        tracemalloc.start()
+    t0 = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        planner(s_start.duplicate(), s_goal.duplicate(), stats = planner_stats, **planner_options)
+    stats = planner_stats.to_dict()
+    stats["total_time"] = time.perf_counter() - t0
+    if measure_memory:
+        stats["peak_memory"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return stats
+
+
+# Run a planner on a scenario and return its metrics
+# Times are the fastest of repeat runs, peak memory is measured in a separate traced run
+def run_scenario(planner, problem, planner_options, repeat = 1, measure_memory = True):
+    runs = [run_scenario_once(planner, problem, planner_options) for i in range(repeat)]
+    metrics = min(runs, key = lambda run: run["total_time"])
+
+    metrics["solved"] = metrics["plan_length"] > 0 or problem[0].equals(problem[1])
+    if measure_memory:
+        metrics["peak_memory"] = run_scenario_once(planner, problem, planner_options, True)["peak_memory"]
+    return metrics
+
+
+# Run a planner on every problem, printing a line per scenario
+# Returns the benchmark results dictionary of metadata and metrics per scenario name
+def run_benchmark(planner, problems, planner_options = None, repeat = 1, measure_memory = True):
+    if planner_options == None:
+        planner_options = dict()
+
+    results = {"metadata": {"created": time.strftime("%Y-%m-%d %H:%M:%S"),
+                            "python": sys.version.split()[0],
+                            "platform": platform.platform(),
+                            "planner_options": planner_options,
+                            "repeat": repeat},
+               "scenarios": dict()}
+
+    for problem in problems:
+        metrics = run_scenario(planner, problem, planner_options, repeat, measure_memory)
+        results["scenarios"][problem[2]] = metrics
+        print_scenario_metrics(problem[2], metrics)
+    return results
+
+
+# Print the metrics of a scenario on one line
+def print_scenario_metrics(name, metrics):
+    line = name.ljust(20)
+    if metrics["solved"]:
+        line += " moves " + str(metrics["plan_length"]).rjust(3)
+    else:
+        line += " NO SOLUTION"
+    line += " | logic " + format(metrics.get("logic_time", 0), ".3f") + " s"
+    line += " | physical " + format(metrics.get("physical_time", 0), ".3f") + " s"
+    line += " | expanded " + str(metrics["states_expanded"])
+    line += " | IK solves " + str(metrics["ik_solves"])
+    if "peak_memory" in metrics:
+        line += " | peak " + format(metrics["peak_memory"] / 1e6, ".1f") + " MB"
+    print(line)
+
+
+# Compare benchmark results to baseline results
+# Returns a list of regression descriptions, empty if no scenario regressed
+def compare_to_baseline(results, baseline, tolerance = DEFAULT_REGRESSION_TOLERANCE):
+    regressions = []
+    for name, metrics in results["scenarios"].items():
+        if name not in baseline["scenarios"]:
+            continue
+        baseline_metrics = baseline["scenarios"][name]
+
+        if baseline_metrics["solved"] and not metrics["solved"]:
+            regressions.append(name + ": no longer solved")
+            continue
+        if metrics["solved"] and baseline_metrics["solved"] and metrics["plan_length"] > baseline_metrics["plan_length"]:
+            regressions.append(name + ": plan length " + str(baseline_metrics["plan_length"]) + " -> " +
+                               str(metrics["plan_length"]))
+
+        for metric, minimum_change in REGRESSION_MINIMUM_CHANGES.items():
+            if metric not in metrics or metric not in baseline_metrics:
+                continue
+            change = metrics[metric] - baseline_metrics[metric]
+            if change > minimum_change and metrics[metric] > baseline_metrics[metric] * (1 + tolerance):
+                regressions.append(name + ": " + metric + " " + format(baseline_metrics[metric], ".4g") + " -> " +
+                                   format(metrics[metric], ".4g"))
+    return regressions
+
+
+# Save benchmark results as JSON
+def save_benchmark_results(results, filename):
+    with open(filename, "w") as results_file:
+        json.dump(results, results_file, indent = 1)
+
+
+# Load benchmark results saved as JSON
+def load_benchmark_results(filename):
+    with open(filename) as results_file:
+        return json.load(results_file)
@@ -0,0 +1,55 @@
+from .utils import adjacent_tuples
+
+
+# This logic layer file details connectivity analysis of module structures, used to decide
+# which modules can be lifted without disconnecting the remaining structure
+
+
+# Return the set of module positions whose removal disconnects the structure (articulation points)
+# Uses an iterative Hopcroft-Tarjan depth first search over face-adjacent modules
+# If the structure is already disconnected, every position is returned as no removal can reconnect it
+def find_articulation_points(positions):
+    positions = set(positions)
+    if len(positions) == 0:
+        return set()
+    
+    root = next(iter(positions))
+    discovery = {root: 0}
+    low = {root: 0}
+    articulation_points = set()
+    root_children = 0
+    
+    # stack of (position, parent position, iterator over adjacent positions)
+    stack = [(root, None, iter(adjacent_tuples(root)))]
+    while len(stack):
+        pos, parent, adjacent_positions = stack[-1]
+        for adj_pos in adjacent_positions:
+            if (adj_pos not in positions) or (adj_pos == parent):
+                continue
+            if adj_pos in discovery:
+                # back edge to an ancestor
+                low[pos] = min(low[pos], discovery[adj_pos])
+            else:
+                # tree edge, descend into adjacent module
+                discovery[adj_pos] = len(discovery)
+                low[adj_pos] = discovery[adj_pos]
+                stack.append((adj_pos, pos, iter(adjacent_tuples(adj_pos))))
+                break
+        else:
+            # all adjacent modules processed, propagate low value to parent
+            stack.pop()
+            if parent is None:
+                continue
+            low[parent] = min(low[parent], low[pos])
+            if parent == root:
+                root_children += 1
+            elif low[pos] >= discovery[parent]:
+                articulation_points.add(parent)
+    
+    # root is an articulation point if it has more than one subtree
+    if root_children > 1:
+        articulation_points.add(root)
+    
+    if len(discovery) != len(positions):
+        return positions
+    return articulation_points
@@ -0,0 +1,430 @@
+import numpy as np
+
+from .task_planner import State, module_type_registry, get_zobrist_value, state_cache
+from .move_filters import is_move_allowed
+from .planner_stats import count_event
+
+
+# This logic layer file details an alternative State implementation backed by a compact
+# occupancy grid of module type IDs, so copies are a single buffer copy and neighbourhood
+# queries are array slices instead of dictionary lookups
+# States generated by GridState.generate_moves are created compact (parent + birth movement),
+# so only the children kept by a search are ever copied
+
+
+# State engines storing planner configurations
+# "dict" - State, a dictionary of position -> Module
+# "grid" - GridState, an occupancy grid of module type IDs
+STATE_ENGINES = ["dict", "grid"]
+DEFAULT_STATE_ENGINE = "dict"
+
+GRID_DTYPE = np.uint16
+GRID_GROWTH_MARGIN = 2      # extra empty cells added around the bounding box when the grid grows
+
+# Grid of a state without modules, grids and offsets are replaced rather than resized in place
+EMPTY_GRID = np.zeros((0, 0, 0), dtype = GRID_DTYPE)
+EMPTY_GRID_OFFSET = np.zeros(3, dtype = int)
+
+# Face-adjacent neighbour offsets (+x, -x, +y, -y, +z, -z)
+NEIGHBOUR_OFFSETS = np.array([[1, 0, 0], [-1, 0, 0],
+                              [0, 1, 0], [0, -1, 0],
+                              [0, 0, 1], [0, 0, -1]])
+
+
+# Return a state with the configuration of state, stored by a state engine (see STATE_ENGINES)
+# The state is returned unchanged if it is already stored by the engine
+def convert_state(state, engine = DEFAULT_STATE_ENGINE):
+    if engine not in STATE_ENGINES:
+        raise ValueError("Unknown state engine: " + str(engine))
+
+    state_class = GridState if engine == "grid" else State
+    if type(state) is state_class:
+        return state
+    converted_state = state_class()
+    for position, module in zip(state.get_module_positions(), state.get_modules()):
+        converted_state.insert(position, module)
+    return converted_state
+
+
+# Return the number of occupied face-adjacent neighbours of every cell of an occupancy grid
+def get_neighbour_counts(occupied):
+    occupied = occupied.astype(np.int8)
+    counts = np.zeros_like(occupied)
+    counts[1:] += occupied[:-1]
+    counts[:-1] += occupied[1:]
+    counts[:, 1:] += occupied[:, :-1]
+    counts[:, :-1] += occupied[:, 1:]
+    counts[:, :, 1:] += occupied[:, :, :-1]
+    counts[:, :, :-1] += occupied[:, :, 1:]
+    return counts
+
+
+# Return (grid, offset) grown so positions between low and high lie inside its empty border
+def grow_grid(grid, offset, low, high):
+    low = np.asarray(low, dtype = int) - 1 - GRID_GROWTH_MARGIN
+    high = np.asarray(high, dtype = int) + 2 + GRID_GROWTH_MARGIN
+    if grid.size:
+        low = np.minimum(low, offset)
+        high = np.maximum(high, offset + grid.shape)
+
+    grown_grid = np.zeros(tuple(high - low), dtype = GRID_DTYPE)
+    if grid.size:
+        start = offset - low
+        end = start + grid.shape
+        grown_grid[start[0]:end[0], start[1]:end[1], start[2]:end[2]] = grid
+    return grown_grid, low
+
+
+# Return True if a grid index lies inside the empty border of a grid
+def is_interior_index(grid, index):
+    return bool(np.all(index >= 1) and np.all(index < np.asarray(grid.shape) - 1))
+
+
+# An implementation of a state configuration stored in an occupancy grid of module type IDs
+# (see task_planner.get_module_type_id), grid index = position - offset
+# The grid always keeps an empty border of at least one cell around all modules
+# Modules returned by a grid state are the registered module of their type
+class GridState(State):
+    def __init__(self):
+        self.stored_grid = None
+        self.offset = EMPTY_GRID_OFFSET
+        self.num_modules = 0
+        self.dict_view = None       # modules_dict built from the grid, dropped when the grid changes
+        State.__init__(self)
+
+
+    # Grids hold type IDs local to a process, so they are pickled as modules and rebuilt when unpickled
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["stored_grid"] = None
+        state["dict_view"] = None
+        state["goal_sets"] = None
+        if not self.is_compact():
+            state["pickled_modules"] = list(self.modules_dict.items())
+        return state
+
+
+    def __setstate__(self, state):
+        pickled_modules = state.pop("pickled_modules", None)
+        self.__dict__.update(state)
+        if pickled_modules != None:
+            hash_key = self.hash_key
+            self.modules_dict = dict(pickled_modules)
+            self.hash_key = hash_key
+
+
+    # Create a grid state from any state configuration
+    def from_state(state):
+        return convert_state(state, "grid")
+
+
+    # Dictionary view of the configuration, built from the grid
+    @property
+    def modules_dict(self):
+        if self.dict_view != None:
+            return self.dict_view
+
+        grid, offset = self.get_grid()
+        indexes = np.argwhere(grid)
+        modules = [module_type_registry[type_id] for type_id in grid[tuple(indexes.T)].tolist()]
+        modules_dict = dict(zip([tuple(pos) for pos in (indexes + offset).tolist()], modules))
+        if not self.is_compact():
+            self.dict_view = modules_dict
+        return modules_dict
+
+
+    @modules_dict.setter
+    def modules_dict(self, modules_dict):
+        self.stored_grid = EMPTY_GRID
+        self.offset = EMPTY_GRID_OFFSET
+        self.num_modules = 0
+        self.dict_view = None
+        self.hash_key = 0
+        for position, module in modules_dict.items():
+            self.insert(position, module)
+
+
+    # Return (grid, offset) of the configuration, materialized from ancestors if the state is compact
+    # A materialized grid is shared with the state cache and must not be modified
+    def get_grid(self):
+        if self.stored_grid is None:
+            return self.materialize()
+        return self.stored_grid, self.offset
+
+
+    # Return True if the state only stores its parent and birth movement
+    def is_compact(self):
+        return self.stored_grid is None
+
+
+    # Drop the stored configuration of a state generated by a movement
+    def compact(self):
+        if self.parent != 0 and self.birth_movement != 0:
+            self.stored_grid = None
+            self.dict_view = None
+            self.goal_sets = None
+
+
+    # Store the full configuration of a compact state
+    def restore(self):
+        if self.is_compact():
+            grid, offset = self.materialize()
+            self.stored_grid = grid.copy()
+            self.offset = offset
+
+
+    # Rebuild the configuration of a compact state by replaying movements from its nearest stored ancestor
+    # Returns (grid, offset), shared with the state cache
+    def materialize(self):
+        cached = state_cache.get(self)
+        if cached != None:
+            return cached
+
+        # find nearest ancestor with a stored or cached configuration
+        chain = [self]
+        ancestor = self.parent
+        while ancestor.is_compact() and state_cache.get(ancestor) == None:
+            chain.append(ancestor)
+            ancestor = ancestor.parent
+        grid, offset = ancestor.get_grid()
+        grid = grid.copy()
+
+        # replay movements from the ancestor to this state
+        for state in reversed(chain):
+            start_pos, end_pos = state.birth_movement
+            start_index = tuple(np.asarray(start_pos, dtype = int) - offset)
+            type_id = grid[start_index]
+            grid[start_index] = 0
+
+            end_index = np.asarray(end_pos, dtype = int) - offset
+            if not is_interior_index(grid, end_index):
+                grid, offset = grow_grid(grid, offset, end_pos, end_pos)
+                end_index = np.asarray(end_pos, dtype = int) - offset
+            grid[tuple(end_index)] = type_id
+
+        state_cache.put(self, (grid, offset))
+        return grid, offset
+
+
+    # Get number of modules in the state
+    def get_num_modules(self):
+        return self.num_modules
+
+
+    # Return a copy of the current state
+    def duplicate(self):
+        grid, offset = self.get_grid()
+        duplicate = GridState()
+        duplicate.stored_grid = grid.copy()
+        duplicate.offset = offset
+        duplicate.num_modules = self.num_modules
+        duplicate.hash_key = self.hash_key
+        return duplicate
+
+
+    # Create a compact child state of a movement from module_pos to move_pos
+    # movement_hash is the Zobrist value of lifting the module from module_pos and placing it at move_pos
+    def create_child(self, module_pos, move_pos, movement_hash):
+        child = GridState()
+        child.stored_grid = None
+        child.parent = self
+        child.birth_movement = [module_pos, move_pos]
+        child.num_modules = self.num_modules
+        child.hash_key = self.hash_key ^ movement_hash
+        return child
+
+
+    # Return type IDs at an array of positions, 0 where a position is empty or outside the grid
+    def get_type_ids(self, positions):
+        grid, offset = self.get_grid()
+        indexes = np.asarray(positions, dtype = int).reshape(-1, 3) - offset
+        inside = np.all((indexes >= 0) & (indexes < grid.shape), axis = 1)
+        type_ids = np.zeros(len(indexes), dtype = GRID_DTYPE)
+        type_ids[inside] = grid[tuple(indexes[inside].T)]
+        return type_ids
+
+
+    # Return type ID at a position, 0 if the position is empty or outside the grid
+    def get_type_id(self, position):
+        grid, offset = self.get_grid()
+        x, y, z = position[0] - offset[0], position[1] - offset[1], position[2] - offset[2]
+        if 0 <= x < grid.shape[0] and 0 <= y < grid.shape[1] and 0 <= z < grid.shape[2]:
+            return int(grid[x, y, z])
+        return 0
+
+
+    # Insert a module into the state at position
+    # The module type is interned (see get_module_type_id), so module comparisons are integer compares
+    def insert(self, position, module):
+        position = tuple(int(x) for x in position)
+        self.restore()
+        index = np.asarray(position) - self.offset
+        if not is_interior_index(self.stored_grid, index):
+            self.stored_grid, self.offset = grow_grid(self.stored_grid, self.offset, position, position)
+            index = np.asarray(position) - self.offset
+
+        index = tuple(index)
+        if self.stored_grid[index] == 0:
+            self.stored_grid[index] = module.get_type_id()
+            self.num_modules += 1
+            self.hash_key ^= get_zobrist_value(position, module)
+            self.dict_view = None
+        self.reset_saved_values()
+
+
+    # Remove module from state from position
+    def remove_module(self, position):
+        position = tuple(int(x) for x in position)
+        self.reset_saved_values()
+        self.restore()
+        type_id = self.get_type_id(position)
+        if type_id == 0:
+            raise KeyError(position)
+
+        module = module_type_registry[type_id]
+        self.stored_grid[tuple(np.asarray(position) - self.offset)] = 0
+        self.num_modules -= 1
+        self.hash_key ^= get_zobrist_value(position, module)
+        self.dict_view = None
+        return module
+
+
+    # Return true if 2 states are equal
+    # Grid states with equal numbers of modules and different hash keys are never equal
+    def equals(self, compared_state):
+        if not isinstance(compared_state, GridState):
+            return State.equals(self, compared_state)
+        if self.num_modules == compared_state.num_modules and self.hash_key != compared_state.hash_key:
+            return False
+
+        grid, offset = self.get_grid()
+        indexes = np.argwhere(grid)
+        return bool(np.all(compared_state.get_type_ids(indexes + offset) == grid[tuple(indexes.T)]))
+
+
+    # Get size of the state (maximum 3D length)
+    def size(self):
+        return np.max(self.get_position_array()) + 1
+
+
+    # Return module positions as an (n, 3) integer array, in the order of get_modules
+    def get_position_array(self):
+        grid, offset = self.get_grid()
+        return np.argwhere(grid) + offset
+
+
+    # Validate whether all modules in a state are connected
+    # Returns True if all modules are connected, else False
+    def is_connected(self):
+        count_event("is_connected_calls")
+        grid, offset = self.get_grid()
+        occupied = grid != 0
+
+        # flood fill the occupied cells from the first module
+        reached = np.zeros_like(occupied)
+        reached[tuple(np.argwhere(occupied)[0])] = True
+        while True:
+            grown = reached.copy()
+            grown[1:] |= reached[:-1]
+            grown[:-1] |= reached[1:]
+            grown[:, 1:] |= reached[:, :-1]
+            grown[:, :-1] |= reached[:, 1:]
+            grown[:, :, 1:] |= reached[:, :, :-1]
+            grown[:, :, :-1] |= reached[:, :, 1:]
+            grown &= occupied
+            if np.array_equal(grown, reached):
+                return bool(np.array_equal(reached, occupied))
+            reached = grown
+
+
+    # Verify a module can be connected to
+    # Return true if module has an exposed face, else False
+    def is_module_removable(self, pos):
+        return len(self.get_adjacent_modules(pos)) < len(NEIGHBOUR_OFFSETS)
+
+
+    # Return True if a module is stacked anywhere above position
+    def has_module_above(self, position):
+        grid, offset = self.get_grid()
+        x, y, z = position[0] - offset[0], position[1] - offset[1], position[2] - offset[2]
+        if not (0 <= x < grid.shape[0] and 0 <= y < grid.shape[1]):
+            return False
+        return bool(grid[x, y, max(z + 1, 0):].any())
+
+
+    # Return module at position, or 0 if position is empty
+    def get_module(self, position):
+        type_id = self.get_type_id(position)
+        return module_type_registry[type_id] if type_id != 0 else 0
+
+
+    # Return array of modules in the state
+    def get_modules(self):
+        grid, offset = self.get_grid()
+        return [module_type_registry[type_id] for type_id in grid[grid != 0].tolist()]
+
+
+    # Return array of module positions in the state
+    def get_module_positions(self):
+        return [tuple(pos) for pos in self.get_position_array().tolist()]
+
+
+    # Get available positions in the state that can be connected to
+    def get_available_positions(self):
+        grid, offset = self.get_grid()
+        occupied = grid != 0
+        return np.argwhere((get_neighbour_counts(occupied) > 0) & ~occupied) + offset
+
+
+    # Get adjacent modules to module in position pos
+    def get_adjacent_modules(self, pos):
+        adjacent_positions = np.asarray(pos, dtype = int) + NEIGHBOUR_OFFSETS
+        occupied = self.get_type_ids(adjacent_positions) != 0
+        return [tuple(adj_pos) for adj_pos in adjacent_positions[occupied].tolist()]
+
+
+    # Generate a new state for each valid movement of each module in module_positions to each movement_position
+    # Return generated states as a list, in the order of State.generate_moves
+    # Valid movements are found with array operations over every (module, movement position) pair and
+    # generated states are compact, see State.generate_moves for move_filters and reverse
+    def generate_moves(self, module_positions, movement_positions, move_filters = None, reverse = False):
+        moveset = []
+        grid, offset = self.get_grid()
+        module_positions = np.asarray(module_positions, dtype = int).reshape(-1, 3)
+        movement_positions = np.asarray(movement_positions, dtype = int).reshape(-1, 3)
+
+        # modules that are articulation points disconnect the state when lifted
+        articulation_points = self.get_articulation_points()
+        module_tuples = [tuple(pos) for pos in module_positions.tolist()]
+
+        # modules with a free face to be grabbed by a manipulator, that keep the state connected when lifted
+        neighbour_counts = get_neighbour_counts(grid != 0)
+        module_indexes = tuple((module_positions - offset).T)
+        removable = ((neighbour_counts[module_indexes] < len(NEIGHBOUR_OFFSETS)) &
+                     np.asarray([pos not in articulation_points for pos in module_tuples], dtype = bool))
+
+        # movement positions adjacent to the remaining structure, once the module is lifted
+        movement_counts = neighbour_counts[tuple((movement_positions - offset).T)]
+        lifted_adjacent = np.abs(module_positions[:, np.newaxis, :] - movement_positions[np.newaxis, :, :]).sum(axis = 2) == 1
+        valid = removable[:, np.newaxis] & ((movement_counts[np.newaxis, :] - lifted_adjacent) > 0)
+
+        # Zobrist values of lifting each module, and of placing each module type at each movement position
+        modules = [module_type_registry[type_id] for type_id in grid[module_indexes].tolist()]
+        lift_hashes = [get_zobrist_value(pos, module) for pos, module in zip(module_tuples, modules)]
+        movement_tuples = [tuple(pos) for pos in movement_positions.tolist()]
+        place_hashes = dict()
+        for module in modules:
+            if module not in place_hashes:
+                place_hashes[module] = [get_zobrist_value(pos, module) for pos in movement_tuples]
+
+        for i, j in np.argwhere(valid).tolist():
+            module_pos = module_tuples[i]
+            move_pos = movement_positions[j]
+            if move_filters and not reverse and not is_move_allowed(move_filters, self, module_pos, move_pos):
+                continue
+            return_state = self.create_child(module_pos, move_pos, lift_hashes[i] ^ place_hashes[modules[i]][j])
+            if move_filters and reverse and not is_move_allowed(move_filters, return_state, move_pos, module_pos):
+                continue
+            moveset.append(return_state)
+        count_event("states_generated", len(moveset))
+        return moveset
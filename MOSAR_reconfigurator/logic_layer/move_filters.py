@@ -0,0 +1,86 @@
+import numpy as np
+
+
+# This logic layer file details move constraint filters applied by State.generate_moves, so moves a
+# mobile manipulator cannot physically perform on a desk are never generated
+# A move filter is called as move_filter(state, module_pos, move_pos), where state is the
+# configuration before module_pos is moved to move_pos, and returns True if the move is allowed
+
+
+# Allow moves placing a module on or above the desk surface
+def is_above_surface(state, module_pos, move_pos):
+    return move_pos[2] >= 0
+
+
+# Allow moves placing a module on the desk or directly on top of another module
+# The moved module cannot support itself
+def is_placement_supported(state, module_pos, move_pos):
+    if move_pos[2] == 0:
+        return True
+    supporting_position = (move_pos[0], move_pos[1], move_pos[2] - 1)
+    return (not np.array_equal(supporting_position, module_pos)) and state.get_module(supporting_position) != 0
+
+
+# Allow moves of modules with no modules stacked above them
+def is_module_liftable(state, module_pos, move_pos):
+    return not state.has_module_above(module_pos)
+
+
+# Filters enforcing the desk surface and gravity
+GRAVITY_MOVE_FILTERS = [is_above_surface, is_placement_supported, is_module_liftable]
+
+
+# Return True if a move passes every move filter
+def is_move_allowed(move_filters, state, module_pos, move_pos):
+    for move_filter in move_filters:
+        if not move_filter(state, module_pos, move_pos):
+            return False
+    return True
+
+
+# Reasons the physical layer rejects a movement
+UNREACHABLE_POSITION = "unreachable position"      # arm cannot reach the position
+UNSUPPORTED_PLACEMENT = "unsupported placement"    # nothing below the placement position
+BLOCKED_LIFT = "blocked lift"                      # modules stacked above the lifted module
+BELOW_SURFACE = "below surface"                    # placement position below the desk surface
+FAILURE_REASONS = [UNREACHABLE_POSITION, UNSUPPORTED_PLACEMENT, BLOCKED_LIFT, BELOW_SURFACE]
+
+
+# A move filter built from physical layer failures (nogoods)
+# Each recorded failure rejects every future move repeating the failure, not only the failed state
+class NogoodSet:
+    def __init__(self):
+        self.nogoods = dict([(reason, set()) for reason in FAILURE_REASONS])
+    
+    
+    def __str__(self):
+        return ", ".join([reason + ": " + str(len(positions)) for reason, positions in self.nogoods.items()])
+    
+    
+    # Record a failure reason at a module grid position
+    def add(self, reason, position):
+        if reason not in self.nogoods:
+            raise ValueError("Unknown failure reason: " + str(reason))
+        self.nogoods[reason].add(tuple(int(x) for x in position))
+    
+    
+    # Return number of recorded nogoods
+    def get_length(self):
+        return sum([len(positions) for positions in self.nogoods.values()])
+    
+    
+    # Move filter rejecting moves that repeat a recorded failure
+    def __call__(self, state, module_pos, move_pos):
+        module_pos = tuple(int(x) for x in module_pos)
+        move_pos = tuple(int(x) for x in move_pos)
+        
+        unreachable = self.nogoods[UNREACHABLE_POSITION]
+        if module_pos in unreachable or move_pos in unreachable:
+            return False
+        if move_pos in self.nogoods[BELOW_SURFACE]:
+            return False
+        if move_pos in self.nogoods[UNSUPPORTED_PLACEMENT] and not is_placement_supported(state, module_pos, move_pos):
+            return False
+        if module_pos in self.nogoods[BLOCKED_LIFT] and not is_module_liftable(state, module_pos, move_pos):
+            return False
+        return True
@@ -0,0 +1,125 @@
+import time
+from contextlib import contextmanager
+
+
+# This logic layer file details planner instrumentation, counting the work done by the logic and
+# physical layers and timing planning phases, so slow planning runs can be understood without a profiler
+
+
+# Counted planner events
+# "searches"                    - logic layer searches run
+# "states_generated"            - child states generated by State.generate_moves
+# "states_expanded"             - states expanded by a search
+# "states_deduplicated"         - generated states skipped as already seen by a search
+# "heuristic_evaluations"       - goal similarity evaluations of states
+# "is_connected_calls"          - full connectivity checks of a state
+# "articulation_point_searches" - searches for modules that disconnect a state
+# "ik_solves"                   - inverse kinematics solves
+# "ik_cache_hits"               - inverse kinematics solutions reused from a reachability map or batch
+# "physical_failures"           - transition plans rejected by the physical layer
+COUNTERS = ["searches", "states_generated", "states_expanded", "states_deduplicated", "heuristic_evaluations",
+            "is_connected_calls", "articulation_point_searches", "ik_solves", "ik_cache_hits", "physical_failures"]
+
+DEFAULT_PROGRESS_INTERVAL = 1000     # states expanded between progress callbacks
+
+
+# Counters, phase timers and plan results of planner runs
+# progress_callback is called with the stats every progress_interval expanded states
+# Counts made in parallel expansion worker processes are not collected
+class PlannerStats:
+    def __init__(self, progress_callback = None, progress_interval = DEFAULT_PROGRESS_INTERVAL):
+        self.counters = dict([(counter, 0) for counter in COUNTERS])
+        self.timers = dict()
+        self.plan_length = 0
+        self.progress_callback = progress_callback
+        self.progress_interval = progress_interval
+
+
+    def __str__(self):
+        lines = ["----- Planner Stats -----"]
+        for counter, value in self.counters.items():
+            lines.append("COUNT: " + counter.ljust(28) + " - " + str(value))
+        for phase, seconds in self.timers.items():
+            lines.append("TIME: " + phase.ljust(29) + " - " + format(seconds, ".4f") + " s")
+        return "\n".join(lines)
+
+
+    # Increase a counter by amount
+    def count(self, counter, amount = 1):
+        self.counters[counter] += amount
+
+
+    # Return the value of a counter
+    def get_count(self, counter):
+        return self.counters[counter]
+
+
+    # Add seconds to the timer of a planning phase
+    def add_time(self, phase, seconds):
+        self.timers[phase] = self.timers.get(phase, 0) + seconds
+
+
+    # Return the total seconds spent in a planning phase
+    def get_time(self, phase):
+        return self.timers.get(phase, 0)
+
+
+    # Time the enclosed block as part of a planning phase
+    @contextmanager
+    def time_phase(self, phase):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.perf_counter() - t0)
+
+
+    # Record an expanded state, calling the progress callback every progress_interval states
+    def count_expansion(self):
+        self.counters["states_expanded"] += 1
+        if self.progress_callback != None and self.counters["states_expanded"] % self.progress_interval == 0:
+            self.progress_callback(self)
+
+
+    # Return a flat dictionary of counters, phase times (as <phase>_time) and the plan length
+    def to_dict(self):
+        stats = dict(self.counters)
+        for phase, seconds in self.timers.items():
+            stats[phase + "_time"] = seconds
+        stats["plan_length"] = self.plan_length
+        return stats
+
+
+# Planner stats receiving counts from state and physical layer methods, set by use_planner_stats
+active_planner_stats = None
+
+
+# Make stats the receiver of counted events, returning the previously active stats
+def use_planner_stats(stats):
+    global active_planner_stats
+    previous_stats = active_planner_stats
+    active_planner_stats = stats
+    return previous_stats
+
+
+# Count an event in the active planner stats, if any
+def count_event(counter, amount = 1):
+    if active_planner_stats != None:
+        active_planner_stats.count(counter, amount)
+
+
+# Count an expanded state in the active planner stats, if any
+def count_expansion():
+    if active_planner_stats != None:
+        active_planner_stats.count_expansion()
+
+
+# Time the enclosed block as part of a phase of the active planner stats, if any
+@contextmanager
+def time_active_phase(phase):
+    stats = active_planner_stats
+    if stats == None:
+        yield
+        return
+    with stats.time_phase(phase):
+        yield
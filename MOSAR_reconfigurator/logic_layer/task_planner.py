@@ -1,9 +1,16 @@
+import os
 import math
+import time
+import heapq
+import random
+from collections import OrderedDict, Counter
+from concurrent.futures import ProcessPoolExecutor
 from .utils import *
+from .connectivity import find_articulation_points
+from .move_filters import is_move_allowed
+from .planner_stats import PlannerStats, use_planner_stats, count_event, count_expansion, time_active_phase
 
 import numpy as np
-from matplotlib import pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
 
 
 # This logic layer file details a simple Task Planner to generate semantic solutions 
@@ -12,78 +19,554 @@ from mpl_toolkits.mplot3d import Axes3D
 
 MAXIMUM_BRANCHES = 5
 
+# Search strategies used to order the search tree frontier
+# "bfs"    - breadth first, states expanded in the order they were generated
+# "greedy" - best first by similarity to the goal state
+# "astar"  - weighted A*, states ordered by moves so far + weight * modules not in final position
+# "beam"   - beam search, only the beam width states most similar to the goal are kept at each depth
+SEARCH_STRATEGIES = ["bfs", "greedy", "astar", "beam"]
+DEFAULT_SEARCH_STRATEGY = "bfs"
+DEFAULT_ASTAR_WEIGHT = 1.0
+
+# Beam search settings
+DEFAULT_BEAM_WIDTH = 64                 # states kept at each depth
+DEFAULT_BEAM_BRANCHING = MAXIMUM_BRANCHES   # children kept from each expanded state
+BEAM_WIDENING_FACTOR = 2                # beam width multiplier after a failed beam search
+MAXIMUM_BEAM_WIDENINGS = 4
+BEAM_DEPTH_FACTOR = 3                   # beam search depth limit per module in the state
+
+# Distance heuristics used to rank states with equal numbers of finalist and free modules
+# "sum"        - sum of distances between every non-final module and every empty final location
+# "assignment" - minimum cost matching of non-final modules to empty final locations of the same type
+DISTANCE_HEURISTICS = ["sum", "assignment"]
+DEFAULT_DISTANCE_HEURISTIC = "sum"
+
+# Maximum number of materialized configurations kept for compacted states
+STATE_CACHE_SIZE = 256
+
+
+# State.display output, set by use_headless_display
+# Headless displays save figures to display_directory, or skip them if it is None
+# matplotlib is only imported when a figure is created
+headless_display = False
+display_directory = None
+num_saved_displays = 0
+
+
+# Show State.display figures in a window, or if headless save them to a directory (None to skip figures)
+def use_headless_display(headless = True, directory = None):
+    global headless_display, display_directory
+    headless_display = headless
+    display_directory = directory
+
+
+# Return an RGBA colour lookup table of type IDs from the module of each type ID
+# Type ID 0 (empty position) is transparent
+def create_colour_table(type_modules):
+    colour_table = np.zeros((len(type_modules), 4))
+    for type_id, module in enumerate(type_modules):
+        if module != 0:
+            colour_table[type_id] = list(module.colour) + [1]
+    return colour_table
+
+
+# Registry of interned module types, module_type_registry[type ID] is a module of the type
+# Type ID 0 is reserved for empty positions, type IDs are local to a process
+module_type_ids = dict()
+module_type_registry = [0]
+
+
+# Return the type ID of a module, registering the module type if unseen
+def get_module_type_id(module):
+    key = module.get_type_key()
+    if key not in module_type_ids:
+        # registered copy, so later changes to the module do not change the registry
+        registered_module = Module(list(module.colour))
+        registered_module.module_type = module.module_type
+        registered_module.type_id = len(module_type_registry)
+        module_type_ids[key] = registered_module.type_id
+        module_type_registry.append(registered_module)
+    return module_type_ids[key]
+
+
+# Zobrist hashing values for each (position, module type ID) pair, generated on first use
+# Values are seeded from the module type key so every process derives the same state hashes
+zobrist_table = dict()
+
+
+# Return the Zobrist hashing value of a module type placed at position
+def get_zobrist_value(position, module):
+    key = (tuple(int(x) for x in position), module.get_type_id())
+    if key not in zobrist_table:
+        zobrist_table[key] = random.Random(repr((key[0], module.get_type_key()))).getrandbits(64)
+    return zobrist_table[key]
+
 
 # Generate priority queue of state transitions
-def generate_states(state, s_goal):
-    states_queue = StateQueue(s_goal)
+# goal_index is built from s_goal if not given, moves rejected by any of move_filters are not generated
+# If reverse is True, move_filters are applied to the reversed movements (see State.generate_moves)
+def generate_states(state, s_goal, heuristic = DEFAULT_DISTANCE_HEURISTIC, goal_index = None, move_filters = None,
+                    reverse = False):
+    if goal_index == None:
+        goal_index = GoalIndex(s_goal)
+    states_queue = StateQueue(s_goal, heuristic, goal_index)
     
     # Get available positions for modules to move to
     available_positions = state.get_available_positions()
+    non_final_positions = goal_index.get_non_final_positions(state, heuristic)
                 
     # Generate movement for each movable module in non_final position
-    generated_moveset = state.generate_moves(state.get_non_final_positions(s_goal), available_positions)
+    generated_moveset = state.generate_moves(non_final_positions, available_positions, move_filters, reverse)
     states_queue.push_multiple(generated_moveset)
 
     # If no new state generated, allow movement of adjacent final modules
     if states_queue.is_empty():
         adjacent_modules = []
-        for module_pos in state.get_non_final_positions(s_goal):
+        for module_pos in non_final_positions:
             adjacent_modules = adjacent_modules + state.get_adjacent_modules(module_pos)
         adjacent_modules = np.unique(adjacent_modules, axis=0)
         
         # Generate movement for each adjacent module to modules in non_final position
-        generated_moveset = state.generate_moves(adjacent_modules, available_positions)
+        generated_moveset = state.generate_moves(adjacent_modules, available_positions, move_filters, reverse)
         states_queue.push_multiple(generated_moveset)
     
     
     # If no new state generated, allow movement of all modules
     if states_queue.is_empty():
         # Generate movement for all modules
-        generated_moveset = state.generate_moves(state.get_module_positions(), available_positions)
+        generated_moveset = state.generate_moves(state.get_module_positions(), available_positions, move_filters,
+                                                   reverse)
         states_queue.push_multiple(generated_moveset)
 
+    # children are evaluated, release the state's goal sets
+    state.goal_sets = None
     return states_queue
 
 
 # Create a task plan to reconfigure state s_start into start s_goal
 # If a search tree is input, planner continues search through search tree
-def find_path(s_start, s_goal, search_tree = None):
-    if search_tree == None:
-        search_tree = []
-    
+# strategy selects the frontier ordering (see SEARCH_STRATEGIES), weight scales the "astar" heuristic
+# heuristic selects the goal distance measure (see DISTANCE_HEURISTICS)
+# workers > 1 expands batches of frontier states in parallel worker processes, forward search only
+# move_filters are move constraints applied when generating states (see move_filters.py)
+# bidirectional searches from both s_start and s_goal (see find_path_bidirectional)
+# time_budget (seconds) or max_expansions bound the search and select anytime planning (see find_path_anytime)
+# beam_width and beam_branching configure the "beam" strategy (see find_path_beam)
+# Search counts and times are recorded in stats, or the search tree's stats if not given (see planner_stats.py),
+# the returned search tree's stats hold them
+# Returns (transition path, search tree), the transition path is 0 if no plan was found
+# The search tree is returned even if the search failed, so the stats of failed searches are kept,
+# (0, 0) is only returned if the states' module compositions differ and no search was run
+# translation_invariant accepts the goal structure at any position and treats translated configurations
+# as the same search state (see State.get_canonical_key)
+# Generated states are stored like s_start, as a State or a grid_state.GridState
+def find_path(s_start, s_goal, search_tree = None, strategy = DEFAULT_SEARCH_STRATEGY, weight = DEFAULT_ASTAR_WEIGHT,
+              heuristic = DEFAULT_DISTANCE_HEURISTIC, workers = 1, move_filters = None, bidirectional = False,
+              time_budget = None, max_expansions = None, beam_width = DEFAULT_BEAM_WIDTH,
+              beam_branching = DEFAULT_BEAM_BRANCHING, stats = None, translation_invariant = False):
     # Confirm contents of each state match
     if not do_contents_match(s_start, s_goal):
         print("ERROR: Start and Goal state do not have an equal composition of modules")
-        return 0
+        return 0, 0
+    
+    if stats == None:
+        stats = search_tree.stats if search_tree != None else PlannerStats()
+    stats.count("searches")
+    
+    anytime = time_budget != None or max_expansions != None
+    if workers > 1 and (strategy == "beam" or bidirectional or anytime or
+                        isinstance(search_tree, (BeamSearchTree, BidirectionalSearchTree))):
+        raise ValueError("Parallel expansion (workers > 1) is not supported by beam, bidirectional or " +
+                         "budgeted search")
+    
+    previous_stats = use_planner_stats(stats)
+    try:
+        with stats.time_phase("search"):
+            if strategy == "beam" or isinstance(search_tree, BeamSearchTree):
+                if anytime or bidirectional or translation_invariant:
+                    raise ValueError("Planning budgets, bidirectional and translation invariant search are not " +
+                                     "supported by beam search")
+                transition_path, search_tree = find_path_beam(s_start, s_goal, search_tree, heuristic, move_filters,
+                                                              beam_width, beam_branching)
+            
+            elif bidirectional or isinstance(search_tree, BidirectionalSearchTree):
+                if anytime or translation_invariant:
+                    raise ValueError("Planning budgets and translation invariant search are not supported by " +
+                                     "bidirectional search")
+                transition_path, search_tree = find_path_bidirectional(s_start, s_goal, search_tree, strategy, weight,
+                                                                       heuristic, move_filters)
+            
+            elif anytime:
+                transition_path, search_tree = find_path_anytime(s_start, s_goal, search_tree, strategy, weight,
+                                                                 heuristic, move_filters, time_budget, max_expansions,
+                                                                 translation_invariant)
+            
+            else:
+                transition_path, search_tree = find_path_forward(s_start, s_goal, search_tree, strategy, weight,
+                                                                 heuristic, workers, move_filters, translation_invariant)
+    finally:
+        use_planner_stats(previous_stats)
+    
+    search_tree.stats = stats
+    return transition_path, search_tree
+
+
+# Create a task plan by searching forward from s_start through a single search tree
+# States are expanded in the search strategy order, batches of states are expanded in parallel if workers > 1
+def find_path_forward(s_start, s_goal, search_tree = None, strategy = DEFAULT_SEARCH_STRATEGY,
+                      weight = DEFAULT_ASTAR_WEIGHT, heuristic = DEFAULT_DISTANCE_HEURISTIC, workers = 1,
+                      move_filters = None, translation_invariant = False):
+    if search_tree == None:
+        search_tree = SearchTree(s_goal, strategy, weight, heuristic, move_filters, translation_invariant)
     
     # Set the recursion limit according to the input state
     recursion_limit = set_recursion_limit(s_start)
     
     recursion_counter = 1
-    s_current = s_start
     
-    # While goal state not found
-    while not s_current.equals(s_goal):
-        # generate state children
-        priority_queue_new = generate_states(s_current, s_goal)
+    # a continued search resumes from its frontier rather than expanding s_start again
+    if search_tree.is_visited(s_start):
+        expansion_batch = []
+    else:
+        expansion_batch = [s_start]
+        search_tree.mark_visited(s_start)
         
-        # add children to list
-        for i in range(MAXIMUM_BRANCHES):
-            if (priority_queue_new.get_length()):
-                s_new = priority_queue_new.pop()
+        # evaluate s_start so its children are evaluated incrementally (see GoalIndex.evaluate_from_parent)
+        search_tree.goal_index.get_priority_key(s_start, search_tree.heuristic)
+    
+    executor = None
+    if workers > 1:
+        executor = create_expansion_pool(s_goal, search_tree.heuristic, workers, search_tree.move_filters)
+    
+    try:
+        while True:
+            # when goal reached, return transition plan and current search tree
+            for s_current in expansion_batch:
+                if search_tree.is_goal(s_current):
+                    return s_current.get_state_path(), search_tree
+            
+            # generate state children, in priority order
+            with time_active_phase("expansion"):
+                if executor == None:
+                    batch_children = [generate_states(s_current, s_goal, search_tree.heuristic,
+                                                      search_tree.goal_index, search_tree.move_filters).drain()
+                                      for s_current in expansion_batch]
+                else:
+                    batch_children = expand_states_parallel(expansion_batch, s_goal, search_tree.heuristic, executor)
+            
+            # add unseen children to list
+            for s_current, children in zip(expansion_batch, batch_children):
+                branches = 0
+                for s_new in children:
+                    if branches >= MAXIMUM_BRANCHES:
+                        break
+                    if search_tree.is_visited(s_new):
+                        count_event("states_deduplicated")
+                        continue
+                    s_new.parent = s_current
+                    s_new.depth = s_current.depth + 1
+                    search_tree.push(s_new)
+                    s_new.compact()
+                    branches += 1
+                s_current.compact()
+                count_expansion()
+            
+            # If every reachable configuration has been explored, no path exists
+            if search_tree.is_empty():
+                print("SEARCH TREE EXHAUSTED! UNABLE TO FIND PATH.")
+                return 0, search_tree
+            
+            # Get next states, one per worker
+            if (recursion_counter < recursion_limit):
+                expansion_batch = []
+                while (len(expansion_batch) < workers) and (not search_tree.is_empty()):
+                    s_current = search_tree.pop()
+                    s_current.restore()
+                    expansion_batch.append(s_current)
+                recursion_counter += len(expansion_batch)
+            else:
+                print("MAX RECURSION COUNT REACHED! UNABLE TO FIND PATH.")
+                return 0, search_tree
+    finally:
+        if executor != None:
+            executor.shutdown()
+
+
+# Create the shortest task plan found within a time budget (seconds) and/or a budget of state expansions
+# The search continues after the goal is first reached, keeping shorter plans until a budget runs out or
+# no frontier state can lead to a shorter plan (each module not in final position needs at least one move)
+# Plans are recorded when the goal state is generated, not only when it is expanded
+# Returns the shortest plan found, else the path to the generated state closest to the goal
+# States are expanded serially and the recursion limit is replaced by the budgets
+def find_path_anytime(s_start, s_goal, search_tree = None, strategy = DEFAULT_SEARCH_STRATEGY,
+                      weight = DEFAULT_ASTAR_WEIGHT, heuristic = DEFAULT_DISTANCE_HEURISTIC, move_filters = None,
+                      time_budget = None, max_expansions = None, translation_invariant = False):
+    if search_tree == None:
+        search_tree = SearchTree(s_goal, strategy, weight, heuristic, move_filters, translation_invariant)
+    goal_index = search_tree.goal_index
+    
+    deadline = math.inf if time_budget == None else time.time() + time_budget
+    max_expansions = math.inf if max_expansions == None else max_expansions
+    
+    best_path = 0
+    best_length = math.inf
+    closest_state = s_start
+    closest_key = goal_index.get_priority_key(s_start, search_tree.heuristic)
+    
+    # a continued search resumes from its frontier, including states held back by a previous plan length
+    if search_tree.is_visited(s_start):
+        search_tree.restore_deferred()
+        s_current = None
+    else:
+        search_tree.mark_visited(s_start)
+        s_current = s_start
+    
+    expansions = 0
+    while True:
+        # when goal reached, keep plan if shorter than the best plan
+        if s_current != None and search_tree.is_goal(s_current):
+            if s_current.depth < best_length:
+                best_path = s_current.get_state_path()
+                best_length = s_current.depth
+        
+        # add unseen children to list
+        elif s_current != None:
+            branches = 0
+            with time_active_phase("expansion"):
+                children = generate_states(s_current, s_goal, search_tree.heuristic, goal_index,
+                                           search_tree.move_filters).drain()
+            for s_new in children:
+                if branches >= MAXIMUM_BRANCHES:
+                    break
+                if search_tree.is_visited(s_new):
+                    count_event("states_deduplicated")
+                    continue
                 s_new.parent = s_current
-                search_tree.append(s_new)
+                s_new.depth = s_current.depth + 1
+                search_tree.push(s_new)
+                
+                # keep plans to the goal as they are generated, so a budget running out before the goal
+                # state is popped still returns the plan
+                if search_tree.is_goal(s_new) and s_new.depth < best_length:
+                    best_path = s_new.get_state_path()
+                    best_length = s_new.depth
+                
+                priority_key = goal_index.get_priority_key(s_new, search_tree.heuristic)
+                if priority_key < closest_key:
+                    closest_state = s_new
+                    closest_key = priority_key
+                s_new.compact()
+                branches += 1
+            s_current.compact()
+            count_expansion()
+            expansions += 1
+        
+        if expansions >= max_expansions or time.time() >= deadline:
+            break
+        
+        # Get next state that could lead to a plan shorter than the best plan
+        s_current = None
+        while not search_tree.is_empty():
+            state = search_tree.pop()
+            priority_key = goal_index.get_priority_key(state, search_tree.heuristic)
+            if state.depth + s_goal.get_num_modules() + priority_key[0] >= best_length:
+                search_tree.defer(state)
+                continue
+            s_current = state
+            s_current.restore()
+            break
+        
+        # no frontier state can improve on the best plan
+        if s_current == None:
+            break
+    
+    if best_path != 0:
+        return best_path, search_tree
+    
+    if s_current == None and search_tree.is_empty():
+        print("SEARCH TREE EXHAUSTED! UNABLE TO FIND PATH.")
+        return 0, search_tree
+    
+    print("PLANNING BUDGET REACHED! RETURNING PATH TO CLOSEST STATE.")
+    return closest_state.get_state_path(), search_tree
+
+
+# Create a task plan with a beam search, keeping at most beam_width states at each depth and at most
+# beam_branching children of each expanded state, so memory and time per depth are bounded
+# If the beam search fails, the beam is widened and the search repeated
+def find_path_beam(s_start, s_goal, search_tree = None, heuristic = DEFAULT_DISTANCE_HEURISTIC, move_filters = None,
+                   beam_width = DEFAULT_BEAM_WIDTH, beam_branching = DEFAULT_BEAM_BRANCHING):
+    if search_tree == None:
+        search_tree = BeamSearchTree(s_goal, heuristic, move_filters, beam_width, beam_branching)
+    
+    max_depth = math.ceil(BEAM_DEPTH_FACTOR * s_start.get_num_modules())
+    for widening in range(MAXIMUM_BEAM_WIDENINGS + 1):
+        s_final = search_tree.search(s_start, max_depth)
+        if s_final != 0:
+            return s_final.get_state_path(), search_tree
+        
+        if widening < MAXIMUM_BEAM_WIDENINGS:
+            search_tree.beam_width *= BEAM_WIDENING_FACTOR
+            print("BEAM SEARCH FAILED! WIDENING BEAM TO", search_tree.beam_width, "STATES.")
+    
+    print("BEAM SEARCH FAILED! UNABLE TO FIND PATH.")
+    return 0, search_tree
+
+
+# Create a task plan by searching forward from s_start and backward from s_goal until the searches meet
+# Moves are reversible, so backward search states are generated with the same moves and their movements
+# are reversed when the two half paths are stitched into one transition plan
+# The direction with the smaller frontier is expanded each step, states are expanded serially
+def find_path_bidirectional(s_start, s_goal, search_tree = None, strategy = DEFAULT_SEARCH_STRATEGY,
+                            weight = DEFAULT_ASTAR_WEIGHT, heuristic = DEFAULT_DISTANCE_HEURISTIC, move_filters = None):
+    if search_tree == None:
+        search_tree = BidirectionalSearchTree(s_start, s_goal, strategy, weight, heuristic, move_filters)
+    forward_tree = search_tree.forward_tree
+    backward_tree = search_tree.backward_tree
+    
+    if s_start.equals(s_goal):
+        return s_start.get_state_path(), search_tree
+    
+    # Set the recursion limit according to the input state
+    recursion_limit = set_recursion_limit(s_start)
+    recursion_counter = 1
+    
+    # a continued search resumes from its frontiers rather than expanding s_start and s_goal again
+    expansion_batch = []
+    for tree, root in [(forward_tree, s_start), (backward_tree, s_goal)]:
+        if tree.get_visited_state(root) == None:
+            tree.mark_visited(root)
+            expansion_batch.append((tree, root))
+    
+    while True:
+        # when searches meet, return joined transition plan and current search tree
+        for tree, s_current in expansion_batch:
+            meeting = search_tree.expand(tree, s_current)
+            if meeting != None:
+                return search_tree.stitch(*meeting).get_state_path(), search_tree
         
-        # Get next state
+        # If either direction has explored every configuration it can reach, the searches cannot meet
+        # Pruned states reopen their parent (see SearchTree.prune), so an empty frontier is not refilled
+        if forward_tree.is_empty() or backward_tree.is_empty():
+            print("SEARCH TREE EXHAUSTED! UNABLE TO FIND PATH.")
+            return 0, search_tree
+        
+        # Get next state from the direction with the smaller frontier
         if (recursion_counter < recursion_limit):
-            s_current = search_tree.pop(0)
+            if forward_tree.get_length() <= backward_tree.get_length():
+                tree = forward_tree
+            else:
+                tree = backward_tree
+            s_current = tree.pop()
+            s_current.restore()
+            expansion_batch = [(tree, s_current)]
             recursion_counter += 1
         else:
             print("MAX RECURSION COUNT REACHED! UNABLE TO FIND PATH.")
-            return 0, 0
-    
-    # when goal reached, return transition plan and current search tree
-    return s_current.get_state_path(), search_tree
+            return 0, search_tree
+
+
+# Parallel state expansion
+# Worker processes hold the goal state and expand compact state payloads, returning the movements
+# and priority keys of generated children so only the chosen children are rebuilt in the main process
+
+# Goal context of an expansion worker process, set by init_expansion_worker
+expansion_worker_context = dict()
+
+
+# Return the distinct module types of a state, in order of first appearance
+def get_module_types(state):
+    return list(dict.fromkeys([module.get_type_key() for module in state.get_modules()]))
+
+
+# Create a pool of worker processes for expanding states towards s_goal
+# move_filters must be picklable (module level functions or objects)
+# Workers store states with the state class of s_goal (see grid_state.STATE_ENGINES)
+def create_expansion_pool(s_goal, heuristic, workers, move_filters = None):
+    module_types = get_module_types(s_goal)
+    goal_payload = create_state_payload(s_goal, module_types)
+    return ProcessPoolExecutor(max_workers = workers, initializer = init_expansion_worker,
+                               initargs = (goal_payload, module_types, heuristic, move_filters, type(s_goal)))
+
+
+# Set up the goal context of an expansion worker process
+def init_expansion_worker(goal_payload, module_types, heuristic, move_filters = None, state_class = None):
+    modules = []
+    for colour, module_type in module_types:
+        module = Module(list(colour))
+        module.module_type = module_type
+        modules.append(module)
+    
+    s_goal = create_state_from_payload(goal_payload, modules, state_class)
+    expansion_worker_context["modules"] = modules
+    expansion_worker_context["state_class"] = state_class
+    expansion_worker_context["module_types"] = module_types
+    expansion_worker_context["s_goal"] = s_goal
+    expansion_worker_context["goal_index"] = GoalIndex(s_goal)
+    expansion_worker_context["heuristic"] = heuristic
+    expansion_worker_context["move_filters"] = move_filters
+
+
+# Return a compact, picklable (positions, module type indexes) description of a state
+def create_state_payload(state, module_types):
+    type_indexes = dict([(module_type, i) for i, module_type in enumerate(module_types)])
+    modules_dict = state.modules_dict
+    positions = np.asarray(list(modules_dict.keys()), dtype = np.int32).reshape(-1, 3)
+    types = np.asarray([type_indexes[module.get_type_key()] for module in modules_dict.values()], dtype = np.int32)
+    return positions, types
+
+
+# Create a state of state_class (State if None) from a state payload, using one module object per module type
+def create_state_from_payload(payload, modules, state_class = None):
+    state = State() if state_class == None else state_class()
+    for position, type_index in zip(payload[0].tolist(), payload[1].tolist()):
+        state.insert(position, modules[type_index])
+    return state
+
+
+# Expand a state payload in a worker process
+# Returns (movements array [start xyz, end xyz], priority keys array) of children in priority order
+def expand_state_payload(payload):
+    context = expansion_worker_context
+    state = create_state_from_payload(payload, context["modules"], context["state_class"])
+    
+    # evaluate the state so its children are evaluated incrementally (see GoalIndex.evaluate_from_parent)
+    context["goal_index"].get_priority_key(state, context["heuristic"])
+    states_queue = generate_states(state, context["s_goal"], context["heuristic"], context["goal_index"],
+                                   context["move_filters"])
+    
+    movements = []
+    priority_keys = []
+    for child in states_queue.drain():
+        movements.append(list(child.birth_movement[0]) + list(child.birth_movement[1]))
+        priority_keys.append(context["goal_index"].get_priority_key(child, context["heuristic"]))
+    return np.asarray(movements, dtype = np.int32).reshape(-1, 6), np.asarray(priority_keys, dtype = float).reshape(-1, 3)
+
+
+# Expand a batch of states in worker processes
+# Returns a generator of children in priority order for each state
+def expand_states_parallel(states, s_goal, heuristic, executor):
+    module_types = get_module_types(s_goal)
+    futures = [executor.submit(expand_state_payload, create_state_payload(state, module_types)) for state in states]
+    return [create_children(state, future.result(), s_goal, heuristic) for state, future in zip(states, futures)]
+
+
+# Rebuild children of a state from the movements and priority keys returned by a worker
+def create_children(state, expansion, s_goal, heuristic):
+    movements, priority_keys = expansion
+    for movement, priority_key in zip(movements.tolist(), priority_keys.tolist()):
+        child = state.duplicate()
+        child.insert(movement[3:], child.remove_module(movement[:3]))
+        child.parent = state
+        child.birth_movement = [tuple(movement[:3]), np.asarray(movement[3:])]
+        
+        # reuse values computed by the worker
+        child.set_goal(s_goal)
+        child.finalist_val = int(-priority_key[0])
+        child.free_val = int(-priority_key[1])
+        child.goal_distance = priority_key[2]
+        child.goal_distance_heuristic = heuristic
+        yield child
 
 
 # Test whether states have equal module compositions
@@ -92,18 +575,34 @@ def do_contents_match(s_start, s_goal):
     if s_start.get_num_modules() != s_goal.get_num_modules():
         return False
     
-    # Confirm composition of modules match
-    unmatched = np.asarray(s_goal.get_modules())
-    for m1 in np.asarray(s_start.get_modules()):
-        for m2 in unmatched:
-            # remove all module in s_goal from unmatched list
-            if Module.equals(m1, m2):
-                unmatched = unmatched[unmatched != m2]
-    
-    # If unmatched array is empty, states are made up of same modules
-    return not len(unmatched)
+    # Confirm counts of each module type match
+    return (Counter([module.get_type_id() for module in s_start.get_modules()]) ==
+            Counter([module.get_type_id() for module in s_goal.get_modules()]))
         
 
+# Return the minimum total distance of matching each position in positions_1
+# to a distinct position of equal type in positions_2
+# scipy is imported here so only the assignment heuristic pays its import time
+def get_assignment_distance(positions_1, types_1, positions_2, types_2):
+    from scipy.optimize import linear_sum_assignment
+
+    # group positions by module type
+    groups = dict()
+    for pos, module_type in zip(positions_1, types_1):
+        groups.setdefault(module_type, ([], []))[0].append(pos)
+    for pos, module_type in zip(positions_2, types_2):
+        groups.setdefault(module_type, ([], []))[1].append(pos)
+    
+    # solve a minimum cost assignment for each module type
+    dist = 0
+    for type_positions_1, type_positions_2 in groups.values():
+        if len(type_positions_1) and len(type_positions_2):
+            costs = distance_matrix(type_positions_1, type_positions_2)
+            rows, cols = linear_sum_assignment(costs)
+            dist += costs[rows, cols].sum()
+    return float(dist)
+
+
 # Return a sensible task planner recursion limit for the number of modules in a state
 # Returns enough recursions for a reconfiguration plan with (1.5 * number of modules) moves
 def set_recursion_limit(state):
@@ -111,31 +610,502 @@ def set_recursion_limit(state):
 
 
 # Remove a state and all states generated from the removed state from the search tree
+# Returns the trimmed search tree
 def trim_state(state, search_tree):
-    trimmed_search_tree = []
-    for s in search_tree:
-        if state not in s.get_state_path():
-            trimmed_search_tree.insert(0, trimmed_search_tree)
-    return trimmed_search_tree
+    search_tree.prune(state)
+    return search_tree
             
         
+# An index of a goal state built once per search, used to evaluate state similarity to the goal
+# Child states are evaluated incrementally from their parent and the single movement that created them
+class GoalIndex:
+    def __init__(self, s_goal):
+        self.s_goal = s_goal
+        
+        # goal position -> module type, and module type -> goal positions
+        self.goal_types = dict()
+        self.type_positions = dict()
+        for position, module in s_goal.modules_dict.items():
+            self.goal_types[position] = module.get_type_id()
+            self.type_positions.setdefault(module.get_type_id(), set()).add(position)
+    
+    
+    # Return sets describing a state's difference from the goal, cached on the state until it is expanded
+    # Returns [non-final positions, their types, empty final positions, their types, assignment cost per type]
+    def get_goal_sets(self, state, heuristic = DEFAULT_DISTANCE_HEURISTIC):
+        if state.goal_sets != None and state.goal_sets[0] is self and state.goal_sets[1] == heuristic:
+            return state.goal_sets[2]
+        
+        state_types = dict()
+        for position, module in state.modules_dict.items():
+            state_types[position] = module.get_type_id()
+        
+        non_final = [pos for pos, module_type in state_types.items() if self.goal_types.get(pos) != module_type]
+        empty_final = [pos for pos, module_type in self.goal_types.items() if state_types.get(pos) != module_type]
+        non_final_types = [state_types[pos] for pos in non_final]
+        empty_final_types = [self.goal_types[pos] for pos in empty_final]
+        
+        assignment_costs = None
+        if heuristic == "assignment":
+            assignment_costs = dict()
+            for module_type in set(non_final_types):
+                assignment_costs[module_type] = self.get_type_assignment_distance(
+                    [pos for pos, t in zip(non_final, non_final_types) if t == module_type],
+                    [pos for pos, t in zip(empty_final, empty_final_types) if t == module_type])
+        
+        goal_sets = [np.asarray(non_final, dtype = float).reshape(-1, 3), non_final_types,
+                     np.asarray(empty_final, dtype = float).reshape(-1, 3), empty_final_types,
+                     assignment_costs]
+        state.goal_sets = [self, heuristic, goal_sets]
+        return goal_sets
+    
+    
+    # Return positions of modules in a state that do not match positions in the goal state
+    def get_non_final_positions(self, state, heuristic = DEFAULT_DISTANCE_HEURISTIC):
+        non_final = self.get_goal_sets(state, heuristic)[0]
+        return [tuple(int(x) for x in pos) for pos in non_final]
+    
+    
+    # Return minimum distance of matching non-final positions to empty final positions of one module type
+    def get_type_assignment_distance(self, non_final, empty_final):
+        return get_assignment_distance(non_final, [0] * len(non_final), empty_final, [0] * len(empty_final))
+    
+    
+    # Return a sortable key of similarity to the goal state, lowest keys are most similar
+    # Ordered by most modules in final position, then most modules in free positions,
+    # then lowest distance between non-final modules and empty final locations (see DISTANCE_HEURISTICS)
+    def get_priority_key(self, state, heuristic = DEFAULT_DISTANCE_HEURISTIC):
+        if not (state.comparison_goal_state == self.s_goal and state.finalist_val != None and
+                state.free_val != None and state.goal_distance != None and
+                state.goal_distance_heuristic == heuristic):
+            count_event("heuristic_evaluations")
+            if self.is_parent_evaluated(state, heuristic):
+                self.evaluate_from_parent(state, heuristic)
+            else:
+                self.evaluate(state, heuristic)
+        return (-state.finalist_val, -state.free_val, state.goal_distance)
+    
+    
+    # Return True if a state can be evaluated incrementally from its parent
+    def is_parent_evaluated(self, state, heuristic):
+        parent = state.parent
+        return (parent != 0 and state.birth_movement != 0 and
+                parent.comparison_goal_state == self.s_goal and parent.finalist_val != None and
+                parent.free_val != None and parent.goal_distance != None and
+                parent.goal_distance_heuristic == heuristic)
+    
+    
+    # Evaluate a state's similarity to the goal state by scanning all positions
+    def evaluate(self, state, heuristic):
+        non_final, non_final_types, empty_final, empty_final_types, assignment_costs = self.get_goal_sets(state, heuristic)
+        state.set_goal(self.s_goal)
+        state.finalist_val = len(self.goal_types) - len(empty_final)
+        state.free_val = len([pos for pos in state.get_module_positions() if pos not in self.goal_types])
+        if heuristic == "assignment":
+            state.goal_distance = float(sum(assignment_costs.values()))
+        else:
+            state.goal_distance = float(distance_matrix(non_final, empty_final).sum())
+        state.goal_distance_heuristic = heuristic
+    
+    
+    # Evaluate a state's similarity to the goal state from its parent's values and birth movement
+    def evaluate_from_parent(self, state, heuristic):
+        parent = state.parent
+        non_final, non_final_types, empty_final, empty_final_types, assignment_costs = self.get_goal_sets(parent, heuristic)
+        start_pos = tuple(int(x) for x in state.birth_movement[0])
+        end_pos = tuple(int(x) for x in state.birth_movement[1])
+        module_type = parent.get_module(start_pos).get_type_id()
+        start_goal_type = self.goal_types.get(start_pos)
+        end_goal_type = self.goal_types.get(end_pos)
+        
+        finalist_val = parent.finalist_val
+        free_val = parent.free_val
+        removed_non_final = []
+        added_non_final = []
+        removed_empty_final = []
+        added_empty_final = []
+        
+        # lifting module from start_pos
+        if start_goal_type == module_type:
+            finalist_val -= 1
+            added_empty_final.append(start_pos)
+        else:
+            removed_non_final.append(start_pos)
+            if start_goal_type == None:
+                free_val -= 1
+        
+        # placing module at end_pos
+        if end_goal_type == module_type:
+            finalist_val += 1
+            removed_empty_final.append(end_pos)
+        else:
+            added_non_final.append(end_pos)
+            if end_goal_type == None:
+                free_val += 1
+        
+        if heuristic == "assignment":
+            # only the assignment of the moved module type changes
+            type_non_final = [tuple(pos) for pos, t in zip(non_final.tolist(), non_final_types) if t == module_type]
+            type_empty_final = [tuple(pos) for pos, t in zip(empty_final.tolist(), empty_final_types) if t == module_type]
+            type_non_final = [pos for pos in type_non_final if pos not in removed_non_final] + added_non_final
+            type_empty_final = [pos for pos in type_empty_final if pos not in removed_empty_final] + added_empty_final
+            goal_distance = (parent.goal_distance - assignment_costs.get(module_type, 0) +
+                             self.get_type_assignment_distance(type_non_final, type_empty_final))
+        else:
+            # update sum over (non-final x empty final) pairs for changed non-final positions
+            goal_distance = parent.goal_distance
+            for pos in removed_non_final:
+                goal_distance -= get_distance_sum(pos, empty_final)
+            for pos in added_non_final:
+                goal_distance += get_distance_sum(pos, empty_final)
+            
+            # then for changed empty final positions against the new non-final positions
+            for positions, sign in [(removed_empty_final, -1), (added_empty_final, 1)]:
+                for pos in positions:
+                    dist = get_distance_sum(pos, non_final)
+                    dist -= sum([math.dist(pos, p) for p in removed_non_final])
+                    dist += sum([math.dist(pos, p) for p in added_non_final])
+                    goal_distance += sign * dist
+        
+        state.set_goal(self.s_goal)
+        state.finalist_val = finalist_val
+        state.free_val = free_val
+        state.goal_distance = float(goal_distance)
+        state.goal_distance_heuristic = heuristic
+
+
+# An implementation of the search tree frontier, a heap of states ordered by the search strategy
+# Configurations pushed to the tree are recorded so they are not expanded twice
+# move_filters are kept with the tree so continued searches apply the same move constraints
+# States pushed to the tree are linked to their parent's children, so a state's subtree can be pruned
+# Configurations are recorded by canonical key, if translation_invariant translated configurations are
+# recorded as one and any translation of the goal is accepted
+class SearchTree:
+    def __init__(self, s_goal, strategy = DEFAULT_SEARCH_STRATEGY, weight = DEFAULT_ASTAR_WEIGHT,
+                 heuristic = DEFAULT_DISTANCE_HEURISTIC, move_filters = None, translation_invariant = False):
+        if strategy not in SEARCH_STRATEGIES:
+            raise ValueError("Unknown search strategy: " + str(strategy))
+        if heuristic not in DISTANCE_HEURISTICS:
+            raise ValueError("Unknown distance heuristic: " + str(heuristic))
+        
+        self.frontier = []
+        self.counter = 0
+        self.num_pruned = 0         # pruned states still in the frontier heap, skipped when popped
+        self.deferred_states = []   # popped states held back from expansion, see defer
+        self.stats = PlannerStats()     # counts and times of every search through the tree
+        self.visited_states = dict()      # canonical key -> state
+        self.translation_invariant = translation_invariant
+        self.s_goal = s_goal
+        self.goal_index = GoalIndex(s_goal)
+        self.strategy = strategy
+        self.weight = weight
+        self.heuristic = heuristic
+        self.move_filters = list(move_filters) if move_filters != None else []
+    
+    
+    # Iterate over states in the frontier
+    def __iter__(self):
+        return iter([entry[-1] for entry in self.frontier if not entry[-1].pruned])
+    
+    
+    # Return number of states in the frontier
+    def get_length(self):
+        return len(self.frontier) - self.num_pruned
+    
+    
+    # Return True if frontier is empty, else False
+    def is_empty(self):
+        return self.get_length() == 0
+    
+    
+    # Return the key configurations are recorded by
+    def get_state_key(self, state):
+        return state.get_canonical_key(self.translation_invariant)
+    
+    
+    # Return True if a state is the goal configuration
+    def is_goal(self, state):
+        if self.translation_invariant:
+            return state.equals_translation(self.s_goal)
+        return state.equals(self.s_goal)
+    
+    
+    # Record a state configuration as seen
+    def mark_visited(self, state):
+        self.visited_states[self.get_state_key(state)] = state
+    
+    
+    # Return the search tree state with the same configuration as state, or None if not seen
+    def get_visited_state(self, state):
+        return self.visited_states.get(self.get_state_key(state))
+    
+    
+    # Return True if a state configuration has already been seen
+    # The goal configuration is never treated as seen, so later searches can reach it by new paths
+    def is_visited(self, state):
+        return (self.get_state_key(state) in self.visited_states and
+                self.get_state_key(state) != self.get_state_key(self.s_goal))
+    
+    
+    # Add a state to the frontier, as a child of its parent state
+    def push(self, state):
+        self.mark_visited(state)
+        if state.parent != 0:
+            state.parent.children.append(state)
+        state.in_frontier = True
+        heapq.heappush(self.frontier, (self.get_priority(state), self.counter, state))
+        self.counter += 1
+    
+    
+    # Remove and return the highest priority state from the frontier
+    def pop(self):
+        state = heapq.heappop(self.frontier)[-1]
+        while state.pruned:
+            self.num_pruned -= 1
+            state = heapq.heappop(self.frontier)[-1]
+        state.in_frontier = False
+        return state
+    
+    
+    # Hold a popped state back from expansion, it stays in the search tree and is returned
+    # to the frontier by restore_deferred
+    def defer(self, state):
+        self.deferred_states.append(state)
+    
+    
+    # Return deferred states to the frontier, other than pruned states
+    def restore_deferred(self):
+        for state in self.deferred_states:
+            self.reopen(state)
+        self.deferred_states = []
+    
+    
+    # Return a state of the search tree to the frontier, so it is expanded again
+    # Pruned states and states already in the frontier are not added
+    def reopen(self, state):
+        if not state.pruned and not state.in_frontier:
+            state.in_frontier = True
+            heapq.heappush(self.frontier, (self.get_priority(state), self.counter, state))
+            self.counter += 1
+    
+    
+    # Remove a state and every state generated from it from the search tree
+    # Pruned configurations are no longer visited, so they can be reached again through other states
+    # The parent of the state is reopened, so its children beyond MAXIMUM_BRANCHES are generated when
+    # it is expanded again (move filters such as NogoodSet keep the pruned movement from being repeated)
+    def prune(self, state):
+        if state.parent != 0 and state in state.parent.children:
+            state.parent.children.remove(state)
+            self.reopen(state.parent)
+        
+        subtree = [state]
+        while len(subtree):
+            s = subtree.pop()
+            s.pruned = True
+            if s.in_frontier:
+                s.in_frontier = False
+                self.num_pruned += 1
+            if self.visited_states.get(self.get_state_key(s)) is s:
+                del self.visited_states[self.get_state_key(s)]
+            subtree.extend(s.children)
+            s.children = []
+    
+    
+    # Return a sortable priority for a state, lowest values are expanded first
+    # Ties are broken by insertion order
+    def get_priority(self, state):
+        if self.strategy == "bfs":
+            return ()
+        
+        priority_key = self.goal_index.get_priority_key(state, self.heuristic)
+        if self.strategy == "greedy":
+            return priority_key
+        
+        # each module not in final position needs at least one more move
+        remaining_moves = state.get_num_modules() + priority_key[0]
+        return (state.depth + self.weight * remaining_moves, remaining_moves, priority_key[2])
+
+
+# Settings and learned state of a beam search
+# Beam searches keep no frontier between searches, pruned states are recorded as forbidden movements
+# from their parent configuration instead
+class BeamSearchTree:
+    def __init__(self, s_goal, heuristic = DEFAULT_DISTANCE_HEURISTIC, move_filters = None,
+                 beam_width = DEFAULT_BEAM_WIDTH, beam_branching = DEFAULT_BEAM_BRANCHING):
+        if heuristic not in DISTANCE_HEURISTICS:
+            raise ValueError("Unknown distance heuristic: " + str(heuristic))
+        
+        self.s_goal = s_goal
+        self.goal_index = GoalIndex(s_goal)
+        self.strategy = "beam"
+        self.heuristic = heuristic
+        self.move_filters = list(move_filters) if move_filters != None else []
+        self.beam_width = beam_width
+        self.beam_branching = beam_branching
+        self.pruned_movements = set()       # (parent hash key, state hash key)
+        self.stats = PlannerStats()
+    
+    
+    # Search from s_start to the goal state for up to max_depth moves
+    # Returns the goal state reached, or 0 if the beam search failed
+    def search(self, s_start, max_depth):
+        if s_start.equals(self.s_goal):
+            return s_start
+        
+        visited_states = set([s_start.get_hash_key()])
+        beam = [s_start]
+        for depth in range(max_depth):
+            candidates = []
+            for state in beam:
+                state.restore()
+                branches = 0
+                with time_active_phase("expansion"):
+                    children = generate_states(state, self.s_goal, self.heuristic, self.goal_index,
+                                               self.move_filters).drain()
+                for s_new in children:
+                    if branches >= self.beam_branching:
+                        break
+                    if (s_new.get_hash_key() in visited_states or
+                        (state.get_hash_key(), s_new.get_hash_key()) in self.pruned_movements):
+                        count_event("states_deduplicated")
+                        continue
+                    visited_states.add(s_new.get_hash_key())
+                    s_new.parent = state
+                    s_new.depth = state.depth + 1
+                    if s_new.equals(self.s_goal):
+                        return s_new
+                    
+                    priority_key = self.goal_index.get_priority_key(s_new, self.heuristic)
+                    candidates.append((priority_key, len(candidates), s_new))
+                    branches += 1
+                state.compact()
+                count_expansion()
+            
+            # dead end, every reachable configuration in the beam has been seen
+            if not len(candidates):
+                return 0
+            
+            beam = [entry[-1] for entry in heapq.nsmallest(self.beam_width, candidates)]
+            for state in beam:
+                state.compact()
+        return 0
+    
+    
+    # Forbid the movement that created a state in later searches
+    def prune(self, state):
+        if state.parent != 0:
+            self.pruned_movements.add((state.parent.get_hash_key(), state.get_hash_key()))
+
+
+# A pair of search trees for bidirectional search, searching forward from s_start to s_goal
+# and backward from s_goal to s_start
+class BidirectionalSearchTree:
+    def __init__(self, s_start, s_goal, strategy = DEFAULT_SEARCH_STRATEGY, weight = DEFAULT_ASTAR_WEIGHT,
+                 heuristic = DEFAULT_DISTANCE_HEURISTIC, move_filters = None):
+        self.forward_tree = SearchTree(s_goal, strategy, weight, heuristic, move_filters)
+        self.backward_tree = SearchTree(s_start, strategy, weight, heuristic, move_filters)
+        self.move_filters = self.forward_tree.move_filters
+        self.backward_tree.move_filters = self.move_filters
+        self.stats = PlannerStats()
+    
+    
+    # Iterate over states in both frontiers
+    def __iter__(self):
+        return iter(list(self.forward_tree) + list(self.backward_tree))
+    
+    
+    # Return number of states in both frontiers
+    def get_length(self):
+        return self.forward_tree.get_length() + self.backward_tree.get_length()
+    
+    
+    # Return True if both frontiers are empty, else False
+    def is_empty(self):
+        return self.forward_tree.is_empty() and self.backward_tree.is_empty()
+    
+    
+    # Expand a state of one search direction, adding its unseen children to that direction's frontier
+    # Returns (forward state, backward state) of equal configuration if the searches meet, else None
+    def expand(self, tree, state):
+        forward = tree is self.forward_tree
+        other_tree = self.backward_tree if forward else self.forward_tree
+        with time_active_phase("expansion"):
+            children = generate_states(state, tree.s_goal, tree.heuristic, tree.goal_index, tree.move_filters,
+                                       not forward).drain()
+        
+        meeting = None
+        branches = 0
+        for s_new in children:
+            if tree.is_visited(s_new):
+                count_event("states_deduplicated")
+                continue
+            
+            # children meeting the other search are kept even past the branch limit
+            other_state = other_tree.get_visited_state(s_new)
+            if branches >= MAXIMUM_BRANCHES and other_state == None:
+                continue
+            s_new.parent = state
+            s_new.depth = state.depth + 1
+            tree.push(s_new)
+            s_new.compact()
+            branches += 1
+            
+            if other_state != None:
+                meeting = (s_new, other_state) if forward else (other_state, s_new)
+                break
+        state.compact()
+        count_expansion()
+        return meeting
+    
+    
+    # Join a forward search state to the backward search state of equal configuration
+    # Returns the final state of the joined plan, whose state path runs from s_start to s_goal
+    def stitch(self, forward_state, backward_state):
+        s_current = forward_state
+        while backward_state.parent != 0:
+            s_next = backward_state.parent.duplicate()
+            s_next.parent = s_current
+            s_next.depth = s_current.depth + 1
+            
+            # reverse the backward search movement
+            start_pos, end_pos = backward_state.birth_movement
+            s_next.birth_movement = [tuple(end_pos), np.asarray(start_pos)]
+            s_next.reverse_state = backward_state
+            
+            s_current = s_next
+            backward_state = backward_state.parent
+        return s_current
+    
+    
+    # Remove a state of a transition plan and all states generated from it from the search trees
+    # Stitched states prune the backward search state their movement was reversed from
+    def prune(self, state):
+        if state.reverse_state != 0:
+            self.backward_tree.prune(state.reverse_state)
+        else:
+            self.forward_tree.prune(state)
+
+
 # An implementation of a state priority queue
 # where priority is defined by similarity to a goal state
 class StateQueue:
-    def __init__(self, s_goal):
-        self.queue = []
+    def __init__(self, s_goal, heuristic = DEFAULT_DISTANCE_HEURISTIC, goal_index = None):
+        self.queue = []         # heap of (priority key, insertion count, state)
+        self.counter = 0
         self.s_goal = s_goal
+        self.heuristic = heuristic
+        self.goal_index = goal_index if goal_index != None else GoalIndex(s_goal)
         
         
     def __str__(self):
         s = "----- State Queue ----- "
         s += "\nLength: " + str(self.get_length())
         count = 1
-        for state in self.queue:
+        for key, _, state in sorted(self.queue, key = lambda entry: entry[:2]):
             s += "\nItem" + str(count) + ":"
-            s += "\n\tFinal modules: " + str(State.get_num_modules_in_final_position(state, self.s_goal))
-            s += "\n\tFree modules: " + str(State.get_num_modules_in_free_position(state, self.s_goal))
-            s += "\n\tDistance modules: " + str(State.get_distance_from_completion(state, self.s_goal))
+            s += "\n\tFinal modules: " + str(-key[0])
+            s += "\n\tFree modules: " + str(-key[1])
+            s += "\n\tDistance modules: " + str(key[2])
             count += 1
         return s
     
@@ -150,87 +1120,147 @@ class StateQueue:
         return len(self.queue) == 0
     
     
-    # Remove and return a state from the front of the queue
+    # Remove and return the highest priority state in the queue
     def pop(self):
-        return self.queue.pop(0)
+        return heapq.heappop(self.queue)[-1]
+    
     
+    # Remove and yield every state in priority order
+    def drain(self):
+        while not self.is_empty():
+            yield self.pop()
     
-    # Insert a state into the queue at an index that maintains priority order
+    
+    # Insert a state into the queue
     def push(self, state):
-        self.queue.insert(self.binary_search(state), state)
+        heapq.heappush(self.queue, self.create_entry(state))
     
     
     # Insert an array of states to the queue
     def push_multiple(self, state_array):
-        for state in state_array:
-            self.push(state)
+        self.queue.extend([self.create_entry(state) for state in state_array])
+        heapq.heapify(self.queue)
     
     
-    # Find a states position in the queue according to priority order
-    def binary_search(self, state):
-        if len(self.queue) == 0:
-            return 0
-            
-        # Use binary search to find state position in queue
-        high = len(self.queue) - 1
-        low = 0
-        
-        while (low <= high):
-            mid = math.floor((high + low) / 2)
-            comparison_val = self.comparator(state, self.queue[mid])
-            if ( comparison_val == 0):
-                return mid
-            elif ( comparison_val > 0 ):
-                # if inserting state higher priority, move search to left of queue
-                high = mid - 1
-            else:
-                # if inserting state lower priority, move search to right of queue
-                low = mid + 1
-        return low
-
-
-    # Return
-    # POSITIVE if state_1 priority is HIGHER than state_2
-    # ZERO     if state_1 priority is EQUAL to state_2
-    # NEGATIVE if state_1 priority is LOWER than state_2
-    def comparator(self, state_1, state_2):
-        # if state_1 has higher number of modules in final position, return positive else negative
-        s1_finalist_num = State.get_num_modules_in_final_position(state_1, self.s_goal)
-        s2_finalist_num = State.get_num_modules_in_final_position(state_2, self.s_goal)
-        if (s1_finalist_num != s2_finalist_num):
-            return s1_finalist_num - s2_finalist_num
-        
-        # if equal, return state with highest number of modules not in final position, but are in free position
-        # if state_1 has higher number of modules not in final pos but in free pos, return positive
-        s1_free_num = State.get_num_modules_in_free_position(state_1, self.s_goal)
-        s2_free_num = State.get_num_modules_in_free_position(state_2, self.s_goal)
-        if (s1_free_num != s2_free_num):
-            return s1_free_num - s2_free_num
-        
-        # if equal finalists and free modules, return state with lowest
-        # sum distance between free modules and final locations
-        # if state_1 distance is lower, return positive
-        s1_dist = State.get_distance_from_completion(state_1, self.s_goal)
-        s2_dist = State.get_distance_from_completion(state_2, self.s_goal)
-        if (s1_dist != s2_dist):
-            return s2_dist - s1_dist
-        
-        # Return equal priority
-        return 0
+    # Create a heap entry for a state, computing its priority key once
+    # Equal priorities are popped in insertion order
+    def create_entry(self, state):
+        entry = (self.goal_index.get_priority_key(state, self.heuristic), self.counter, state)
+        self.counter += 1
+        return entry
+
+
+# A bounded least recently used cache of configurations materialized for compacted states
+class StateCache:
+    def __init__(self, max_size = STATE_CACHE_SIZE):
+        self.cache = OrderedDict()
+        self.max_size = max_size
+    
+    
+    # Return the cached configuration of a state, or None if not cached
+    def get(self, state):
+        if state not in self.cache:
+            return None
+        self.cache.move_to_end(state)
+        return self.cache[state]
+    
+    
+    # Cache the configuration of a state, evicting the least recently used configuration if full
+    def put(self, state, modules_dict):
+        self.cache[state] = modules_dict
+        self.cache.move_to_end(state)
+        if len(self.cache) > self.max_size:
+            self.cache.popitem(last = False)
+    
+    
+    # Remove all cached configurations
+    def clear(self):
+        self.cache.clear()
+
+
+state_cache = StateCache()
 
 
 # An implementation of a state configuration and associated functions
+# A state generated by a movement can be compacted to store only its parent and birth movement,
+# its configuration is then rebuilt from its ancestors when next used
 class State:
     def __init__(self):
         self.parent = 0
         self.birth_movement = 0
+        self.depth = 0
+        self.hash_key = 0
+        self.translated_key = None      # translation invariant key, see get_canonical_key
         self.modules_dict = dict()
         
+        # search tree links, set when the state is pushed to a search tree
+        self.children = []
+        self.in_frontier = False
+        self.pruned = False
+        self.reverse_state = 0      # backward search state a stitched bidirectional path state was built from
+        
         # values for state queue comparison
         self.comparison_goal_state = None
         self.finalist_val = None
         self.free_val = None
         self.goal_distance = None
+        self.goal_distance_heuristic = None
+        self.goal_sets = None
+    
+    
+    # Configuration of the state, materialized from ancestors if the state is compact
+    @property
+    def modules_dict(self):
+        if self.stored_modules_dict == None:
+            return self.materialize()
+        return self.stored_modules_dict
+    
+    
+    @modules_dict.setter
+    def modules_dict(self, modules_dict):
+        self.stored_modules_dict = modules_dict
+    
+    
+    # Return True if the state only stores its parent and birth movement
+    def is_compact(self):
+        return self.stored_modules_dict == None
+    
+    
+    # Drop the stored configuration of a state generated by a movement
+    def compact(self):
+        if self.parent != 0 and self.birth_movement != 0:
+            self.stored_modules_dict = None
+            self.goal_sets = None
+    
+    
+    # Store the full configuration of a compact state
+    def restore(self):
+        if self.is_compact():
+            self.stored_modules_dict = self.materialize().copy()
+    
+    
+    # Rebuild the configuration of a compact state by replaying movements from its nearest stored ancestor
+    # Returned configuration is shared with the state cache and must not be modified
+    def materialize(self):
+        modules_dict = state_cache.get(self)
+        if modules_dict != None:
+            return modules_dict
+        
+        # find nearest ancestor with a stored or cached configuration
+        chain = [self]
+        ancestor = self.parent
+        while ancestor.is_compact() and state_cache.get(ancestor) == None:
+            chain.append(ancestor)
+            ancestor = ancestor.parent
+        modules_dict = ancestor.modules_dict.copy()
+        
+        # replay movements from the ancestor to this state
+        for state in reversed(chain):
+            start_pos, end_pos = state.birth_movement
+            modules_dict[tuple(end_pos)] = modules_dict.pop(tuple(start_pos))
+        
+        state_cache.put(self, modules_dict)
+        return modules_dict
     
     
     # Get number of modules in the state
@@ -242,6 +1272,7 @@ class State:
     def duplicate(self):
         duplicate = State()
         duplicate.modules_dict = self.modules_dict.copy()
+        duplicate.hash_key = self.hash_key
         return duplicate
         
     
@@ -255,23 +1286,31 @@ class State:
     
     # Reset saved similarity measurements
     def reset_saved_values(self):
+        self.translated_key = None
         self.finalist_val = None
         self.free_val = None
         self.goal_distance = None
 
     
     # Insert a module into the state at position
+    # The module type is interned (see get_module_type_id), so module comparisons are integer compares
     def insert(self, position, module):          
         position = tuple(position)
+        self.restore()
+        module.get_type_id()
         if position not in self.modules_dict:
             self.modules_dict[position] = module
+            self.hash_key ^= get_zobrist_value(position, module)
         self.reset_saved_values()
         
     
     # Remove module from state from position
     def remove_module(self, position):
         self.reset_saved_values()
-        return self.modules_dict.pop(position)
+        self.restore()
+        module = self.modules_dict.pop(tuple(position))
+        self.hash_key ^= get_zobrist_value(position, module)
+        return module
     
     
     # Move a module from start_pos to end_pos, if movement is valid
@@ -285,11 +1324,58 @@ class State:
         return state if (t1 and t2) else 0
     
     
+    # Return hash key of the state configuration
+    # States with equal module types in equal positions share a hash key
+    def get_hash_key(self):
+        return self.hash_key
+    
+    
+    # Return key identifying the state configuration
+    # Zobrist values depend only on module type, so configurations differing by a permutation of
+    # interchangeable modules share a key
+    # If translation_invariant, configurations differing by a translation of the whole structure share a key
+    def get_canonical_key(self, translation_invariant = False):
+        if not translation_invariant:
+            return self.hash_key
+        
+        if self.translated_key == None:
+            positions = self.get_position_array()
+            origin = positions.min(axis = 0) if len(positions) else np.zeros(3, dtype = int)
+            translated_key = 0
+            for position, module in zip((positions - origin).tolist(), self.get_modules()):
+                translated_key ^= get_zobrist_value(position, module)
+            self.translated_key = translated_key
+        return self.translated_key
+    
+    
+    # Return true if 2 states are equal up to a translation of the whole structure
+    def equals_translation(self, compared_state):
+        if self.get_canonical_key(True) != compared_state.get_canonical_key(True):
+            return False
+        
+        positions = self.get_position_array()
+        compared_positions = compared_state.get_position_array()
+        if len(positions) != len(compared_positions):
+            return False
+        if len(positions) == 0:
+            return True
+        
+        # translate compared positions onto this state
+        offset = positions.min(axis = 0) - compared_positions.min(axis = 0)
+        modules_dict = self.modules_dict
+        for position, module in zip((compared_positions + offset).tolist(), compared_state.get_modules()):
+            if not Module.equals(modules_dict.get(tuple(position), 0), module):
+                return False
+        return True
+    
+    
     # Return true if 2 states are equal
     def equals(self, compared_state):
-        for pos in self.get_module_positions():
-            if ((pos not in compared_state.modules_dict) or 
-                (not Module.equals(self.modules_dict[pos], compared_state.modules_dict[pos]))):
+        modules_dict = self.modules_dict
+        compared_modules_dict = compared_state.modules_dict
+        for pos in modules_dict:
+            if ((pos not in compared_modules_dict) or 
+                (not Module.equals(modules_dict[pos], compared_modules_dict[pos]))):
                 return False
         return True
     
@@ -299,9 +1385,15 @@ class State:
         return np.max(list(self.modules_dict.keys())) + 1
     
     
-    # Return a position matrix of the current state
-    def to_position_matrix(self, min_size = 0):
-        positions = list(self.modules_dict.keys())
+    # Return module positions as an (n, 3) integer array, in the order of get_modules
+    def get_position_array(self):
+        return np.array(list(self.modules_dict.keys()), dtype = int).reshape(-1, 3)
+    
+    
+    # Return (module positions as matrix indexes, matrix size) of a cubic matrix of at least min_size
+    # Negative positions are shifted into positive space
+    def get_matrix_indexes(self, min_size = 0):
+        positions = self.get_position_array()
         max_val, min_val = max_min(positions)
         
         # shift module positions to move negative positions into positive space
@@ -311,31 +1403,44 @@ class State:
         max_val += 1
         size = max_val if max_val > min_size else min_size
         size += adjustment_val
+        return positions + adjustment_val, int(size)
+    
+    
+    # Return a position matrix of the current state
+    def to_position_matrix(self, min_size = 0):
+        indexes, size = self.get_matrix_indexes(min_size)
+        modules = np.empty(len(indexes), dtype = 'object')
+        modules[:] = self.get_modules()
         
-        # Copy dictionary to position matrix
         position_matrix = np.zeros((size, size, size), dtype = 'object')
-        for pos in positions:
-            pos_adjusted = increment_tuple(pos, adjustment_val)
-            position_matrix[pos_adjusted] = self.modules_dict[pos]
+        position_matrix[tuple(indexes.T)] = modules
         return position_matrix
     
     
-    # Create a colour mask for state visualisation
+    # Return (type ID matrix, module of each type ID) of the current state
+    # Type ID 0 is an empty position, interchangeable modules share a type ID (see get_module_type_id)
+    def to_type_matrix(self, min_size = 0):
+        indexes, size = self.get_matrix_indexes(min_size)
+        type_matrix = np.zeros((size, size, size), dtype = np.int32)
+        type_matrix[tuple(indexes.T)] = [module.get_type_id() for module in self.get_modules()]
+        return type_matrix, list(module_type_registry)
+    
+    
+    # Create an RGBA colour mask for state visualisation, empty positions have zero alpha
     def create_colour_mask(self, min_size = 0):
-        # Get position matrix
-        colour_mask = self.to_position_matrix(min_size)
-        
-        # Replace each module in matrix with the module colour
-        it = np.nditer(colour_mask, flags=['multi_index', 'refs_ok'])
-        for x in it:
-            if x.item() != 0:
-                colour_mask[it.multi_index] = colour_mask[it.multi_index].colour
-        return colour_mask
+        type_matrix, type_modules = self.to_type_matrix(min_size)
+        return create_colour_table(type_modules)[type_matrix]
         
     
     # Create and display a figure of the current state
     # Argument label is the displayed figure title
+    # Headless figures are saved to the display directory or skipped (see use_headless_display)
     def display(self, label = ""):
+        global num_saved_displays
+        if headless_display and display_directory == None:
+            return 0
+        from matplotlib import pyplot as plt
+        
         # Get colour mask
         colour_mask = self.create_colour_mask()
         
@@ -346,11 +1451,19 @@ class State:
         ax.axis("off")
         
         # Display mask
-        container = ax.voxels(colour_mask,
+        container = ax.voxels(colour_mask[..., 3] > 0,
                                 facecolors = colour_mask, 
                                 edgecolors = 'k',
                                 linewidth = 0.5)        
         
+        if headless_display:
+            os.makedirs(display_directory, exist_ok = True)
+            num_saved_displays += 1
+            filename = str(num_saved_displays) + "_" + (label or "state").replace(" ", "_") + ".png"
+            plt.savefig(os.path.join(display_directory, filename))
+            plt.close()
+            return container
+        
         plt.show(block=True)
         return container
     
@@ -358,11 +1471,12 @@ class State:
     # Validate whether all modules in a state are connected
     # Returns True if all modules are connected, else False
     def is_connected(self):     
-        processed_modules = []
-        discovered_modules = []
+        count_event("is_connected_calls")
+        processed_modules = set()
         
         # Add first module in dictionary to discovered modules
-        discovered_modules.append(list(self.modules_dict.keys())[0])
+        discovered_modules = [next(iter(self.modules_dict))]
+        discovered_set = set(discovered_modules)
         
         # Process all discovered modules
         while len(discovered_modules):
@@ -372,14 +1486,21 @@ class State:
             
             # If neighbour has not been discovered yet, add to discovered modules
             for adj_mod in adjacent_modules:
-                if (adj_mod not in processed_modules) and (adj_mod not in discovered_modules):
+                if adj_mod not in discovered_set:
                     discovered_modules.append(adj_mod)
-            processed_modules.append(mod)
+                    discovered_set.add(adj_mod)
+            processed_modules.add(mod)
         
         # if number of discovered modules matches number of module in the state, return True
         return len(processed_modules) == len(self.modules_dict)
     
     
+    # Get positions of modules that would disconnect the state if removed
+    def get_articulation_points(self):
+        count_event("articulation_point_searches")
+        return find_articulation_points(self.get_module_positions())
+    
+    
     # Verify a module can be connected to
     # Return true if module has an exposed face, else False
     def is_module_removable(self, pos):      
@@ -391,16 +1512,30 @@ class State:
         return False
     
     
+    # Return True if a module is stacked anywhere above position
+    def has_module_above(self, position):
+        for pos in self.modules_dict:
+            if (pos[0] == position[0]) and (pos[1] == position[1]) and (pos[2] > position[2]):
+                return True
+        return False
+    
+    
     # Return state transition history
     def get_state_path(self):
         task_plan_list = [self]
 
-        while task_plan_list[0].parent != 0:
-            task_plan_list.insert(0, task_plan_list[0].parent)
-            
+        while task_plan_list[-1].parent != 0:
+            task_plan_list.append(task_plan_list[-1].parent)
+        
+        task_plan_list.reverse()
         return task_plan_list
         
     
+    # Return module at position, or 0 if position is empty
+    def get_module(self, position):
+        return self.modules_dict.get(tuple(position), 0)
+    
+    
     # Return array of modules in the state
     def get_modules(self):
         return list(self.modules_dict.values())
@@ -410,95 +1545,41 @@ class State:
         return list(self.modules_dict.keys())
             
     
+    # Return a sortable key of similarity to the goal state, lowest keys are most similar
+    # Evaluated by a GoalIndex of the goal state (see GoalIndex.get_priority_key)
+    def get_priority_key(self, goal_state, heuristic = DEFAULT_DISTANCE_HEURISTIC):
+        return GoalIndex(goal_state).get_priority_key(self, heuristic)
+    
+    
+    # Return the heuristic of the state's saved similarity measurements, or the default heuristic
+    def get_saved_heuristic(self):
+        if self.goal_distance_heuristic != None:
+            return self.goal_distance_heuristic
+        return DEFAULT_DISTANCE_HEURISTIC
+    
+    
     # Get number of modules in the current state that match positions in the goal state
     def get_num_modules_in_final_position(self, goal_state):
-        # if value already computed, return
-        if self.comparison_goal_state == goal_state and self.finalist_val != None:
-            return self.finalist_val
-        
-        if self.comparison_goal_state != goal_state:
-            self.set_goal(goal_state)
-        
-        count = 0
-        
-        for position in self.get_module_positions():
-            # if position is occupied in both states
-            if position in goal_state.modules_dict:
-                #if position is occupied with equal modules
-                if Module.equals(self.modules_dict[position], goal_state.modules_dict[position]):
-                    count += 1
-                
-        self.finalist_val = count
-        return self.finalist_val
+        return -self.get_priority_key(goal_state, self.get_saved_heuristic())[0]
     
     
     # Get number of modules in the current state that do not match positions in the goal state
     def get_non_final_positions(self, goal_state):
-        results = []
-        
-        # if position not occupied
-        # or
-        # if modules don't match
-        for position in self.get_module_positions():
-            if position not in goal_state.modules_dict:
-                results.append(position)
-            else:
-                if not Module.equals(self.modules_dict[position], goal_state.modules_dict[position]):
-                    results.append(position)
-                
-        return results
+        return GoalIndex(goal_state).get_non_final_positions(self)
     
     
     # Get number of modules in the current state that do not match positions in the goal state,
     # and are in positions that are not occupied in the goal state
     def get_num_modules_in_free_position(self, goal_state):
-        # if value already computed, return
-        if self.comparison_goal_state == goal_state and self.free_val != None:
-            return self.free_val
-        
-        if self.comparison_goal_state != goal_state:
-            self.set_goal(goal_state)
-            
-        count = 0
-        for position in self.get_module_positions():
-            if position not in goal_state.modules_dict:
-                count += 1
-                
-        self.free_val = count
-        return self.free_val
+        return -self.get_priority_key(goal_state, self.get_saved_heuristic())[1]
     
     
     # Get euclidean distance of all non-final modules to their final positions
-    def get_distance_from_completion(self, goal_state):
-        # if value already computed, return
-        if self.comparison_goal_state == goal_state and self.goal_distance != None:
-            return self.goal_distance
-        
-        if self.comparison_goal_state != goal_state:
-            self.set_goal(goal_state)
-            
-        # get modules positions not in final pos
-        # get empty final module locations
-        non_final_module_positions = self.get_non_final_positions(goal_state)
-        empty_final_positions = []
-        
-        # if position not occupied
-        # or
-        # if modules don't match
-        for position in goal_state.get_module_positions():
-            if not ((position in self.modules_dict) and 
-                    (Module.equals(goal_state.modules_dict[position], self.modules_dict[position]))):
-                empty_final_positions.append(position)
-        
-    
-        # for each module not in final pos, get sum of distances to empty final locations
-        dist = 0
-        for p1 in non_final_module_positions:
-            for p2 in empty_final_positions:
-                dist += np.linalg.norm(np.asarray(p1) - np.asarray(p2))
-                
-        self.goal_distance = dist
-        return self.goal_distance
+    # heuristic "sum" totals the distance from each non-final module to every empty final location
+    # heuristic "assignment" totals the distance of the cheapest matching of non-final modules
+    # to empty final locations of the same module type
+    def get_distance_from_completion(self, goal_state, heuristic = DEFAULT_DISTANCE_HEURISTIC):
+        return self.get_priority_key(goal_state, heuristic)[2]
     
     
     # Get available positions in the state that can be connected to
@@ -518,41 +1599,50 @@ class State:
     # Get adjacent modules to module in position pos
     def get_adjacent_modules(self, pos):
         adjacent_modules = []
+        modules_dict = self.modules_dict
         for adjacent_pos in State.get_adjacent_positions(pos):
-            if adjacent_pos in self.modules_dict:
+            if adjacent_pos in modules_dict:
                 adjacent_modules.append(adjacent_pos)
         return adjacent_modules
     
     
     # Get adjacent positions to position
     def get_adjacent_positions(position):
-        # get adjacent positions
-        adjacent_positions = []
-        for i in range(0,3):
-            adjacent_positions.append(increment_tuple_val(position, i, 1))
-            adjacent_positions.append(increment_tuple_val(position, i, -1))
-        return adjacent_positions
+        return adjacent_tuples(tuple(position))
     
     
     # Generate a new state for each valid movement of each module in module_positions to each movement_position
     # Return generated states as a list
-    def generate_moves(self, module_positions, movement_positions):
+    # Moves rejected by any of move_filters are not generated (see move_filters.py)
+    # If reverse is True, states are generated for a backward search and move_filters are applied to the
+    # reversed movement, from the generated state back to this state
+    def generate_moves(self, module_positions, movement_positions, move_filters = None, reverse = False):
         moveset = []
+        
+        # modules that are articulation points disconnect the state when lifted
+        articulation_points = self.get_articulation_points()
+        
         for module_pos in module_positions:
             # If module has an available connection point to be grabbed by a manipulator
-            if (self.is_module_removable(module_pos)):
-                # if state valid without module
+            # and state remains connected without module
+            if (self.is_module_removable(module_pos)) and (tuple(module_pos) not in articulation_points):
                 tmp = self.duplicate()
                 mod = tmp.remove_module(tuple(module_pos))
                 
-                if tmp.is_connected():
-                    # For each available position, generate a valid state with the possible movement
-                    for move_pos in movement_positions:
+                # For each available position adjacent to the remaining structure,
+                # generate a valid state with the possible movement
+                for move_pos in movement_positions:
+                    if len(tmp.get_adjacent_modules(tuple(move_pos))):
+                        if move_filters and not reverse and not is_move_allowed(move_filters, self, module_pos, move_pos):
+                            continue
                         return_state = tmp.duplicate()
                         return_state.insert(tuple(move_pos), mod)
-                        if return_state.is_connected():
-                            return_state.birth_movement = [module_pos, move_pos]
-                            moveset.append(return_state)
+                        if move_filters and reverse and not is_move_allowed(move_filters, return_state, move_pos, module_pos):
+                            continue
+                        return_state.parent = self
+                        return_state.birth_movement = [module_pos, move_pos]
+                        moveset.append(return_state)
+        count_event("states_generated", len(moveset))
         return moveset
         
     
@@ -560,24 +1650,45 @@ class State:
 class Module:
     id_number = 0
     module_type = 'basic'
+    type_id = 0     # interned module type ID, assigned on first use
     
     # Initialize module with identifying colour
     def __init__(self, colour):
         self.colour = colour
         
+    
+    # Type IDs are local to a process, so they are assigned again after unpickling
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("type_id", None)
+        return state
+        
         
     def __str__(self):
         return f"""Module - {self.id_number}: \n\tColour: {self.colour}\n\tType: {self.module_type}"""
     
     
-    # Return true if 2 modules are of equal colour
+    # Return a hashable key identifying interchangeable modules
+    def get_type_key(self):
+        return (tuple(self.colour), self.module_type)
+    
+    
+    # Return the interned type ID of the module
+    def get_type_id(self):
+        if self.type_id == 0:
+            self.type_id = get_module_type_id(self)
+        return self.type_id
+    
+    
+    # Return true if 2 modules are of equal type
     def equals(mod_1, mod_2):
         return (mod_1 != 0 and 
                 mod_2 != 0 and
-                mod_1.colour == mod_2.colour)
+                mod_1.get_type_id() == mod_2.get_type_id())
         
     # Set module colour
     def set_colour(self, colour):
         self.colour = colour
+        self.type_id = 0
         
         
@@ -11,11 +11,24 @@ def increment_tuple_val(pos, index, increment):
     return tuple(a)
 
 def max_min(array):
-    min = 0
-    max = 0
-    for n in np.asarray(array).flatten():
-        if n > max:
-            max = n
-        if n < min:
-            min = n
-    return max, min
\ No newline at end of file
+    array = np.asarray(array)
+    return array.max(initial = 0), array.min(initial = 0)
+
+def adjacent_tuples(pos):
+    x, y, z = pos
+    return [(x + 1, y, z), (x - 1, y, z),
+            (x, y + 1, z), (x, y - 1, z),
+            (x, y, z + 1), (x, y, z - 1)]
+
+
+def distance_matrix(positions_1, positions_2):
+    positions_1 = np.asarray(positions_1, dtype = float).reshape(-1, 3)
+    positions_2 = np.asarray(positions_2, dtype = float).reshape(-1, 3)
+    differences = positions_1[:, np.newaxis, :] - positions_2[np.newaxis, :, :]
+    return np.sqrt((differences ** 2).sum(axis = 2))
+
+
+def get_distance_sum(position, positions):
+    if len(positions) == 0:
+        return 0
+    return np.sqrt(((positions - position) ** 2).sum(axis = 1)).sum()
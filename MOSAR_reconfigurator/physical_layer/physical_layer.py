@@ -1,10 +1,10 @@
-import ikpy.chain as ik
-import ikpy.utils.plot as plot_utils
-
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
+import os
+from concurrent.futures import ProcessPoolExecutor
 
 from logic_layer.task_planner import State
+from logic_layer.move_filters import GRAVITY_MOVE_FILTERS
+from logic_layer.move_filters import UNSUPPORTED_PLACEMENT, BLOCKED_LIFT, BELOW_SURFACE
+from logic_layer.planner_stats import count_event
 import numpy as np
 
 
@@ -12,42 +12,168 @@ import numpy as np
 # verification of Logic Layer semantic solutions and the generation of mobile manipulator instructions sets
 
 
-# Import mobile manipulator specifications
-my_chain = ik.Chain.from_urdf_file("physical_layer/arm_urdf.urdf", active_links_mask=[False, True, True, True, True, True, True])
+# Mobile manipulator specifications
+URDF_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "arm_urdf.urdf")
+ACTIVE_LINKS_MASK = [False, True, True, True, True, True, True]
 HOME_POSITION_ANGLES = [0, 0, 1, -2.5, 0, -1.6, 0]
 END_POSITION_ERROR_MARGIN = 0.0015 # 1.5 mm
+MODULE_TARGET_OFFSET = [0.05, 0.05, 0.1]    # middle of module top face from module position
+
+
+# A physically infeasible movement, the state it creates, the failure reason (see move_filters.FAILURE_REASONS)
+# and the module grid position that caused the failure
+class PhysicalFailure:
+    def __init__(self, state, reason, position):
+        self.state = state
+        self.reason = reason
+        self.position = tuple(int(x) for x in position)
+    
+    
+    def __str__(self):
+        return "PHYSICAL FAILURE: " + self.reason + " at " + str(self.position)
+
+
+# Mobile manipulator kinematic chain, built from URDF_FILE by get_chain on first use
+# ikpy is only imported when inverse kinematics is solved
+my_chain = None
+
+
+# Return the mobile manipulator kinematic chain
+def get_chain():
+    global my_chain
+    if my_chain == None:
+        import ikpy.chain as ik
+        my_chain = ik.Chain.from_urdf_file(URDF_FILE, active_links_mask = ACTIVE_LINKS_MASK)
+    return my_chain
+
+
+# Precomputed reachability map used in place of inverse kinematics solves, see reachability_map.py
+active_reachability_map = None
+
+
+# Use a reachability map for poses of its arm position, or None to always solve inverse kinematics
+def use_reachability_map(reachability_map):
+    global active_reachability_map
+    active_reachability_map = reachability_map
+
+
+# Return (True if reachable, joint angles) for a module grid position (decimetres) from the active
+# reachability map, or None if the map does not cover the position
+def lookup_module_pose(arm_position, position):
+    reachability_map = active_reachability_map
+    if reachability_map == None or not np.allclose(reachability_map.arm_position, arm_position):
+        return None
+    
+    # only whole grid positions are stored
+    position = np.asarray(position, dtype = float)
+    if not np.allclose(position, np.round(position)):
+        return None
+    return reachability_map.get_solution(np.round(position).astype(int))
+
+
+# Return logic layer move filters for the physical constraints of an arm positioned at arm_position
+# Arm reachability is only filtered when a reachability map for the arm position is active
+def get_move_filters(arm_position):
+    move_filters = list(GRAVITY_MOVE_FILTERS)
+    reachability_map = active_reachability_map
+    if reachability_map != None and np.allclose(reachability_map.arm_position, arm_position):
+        move_filters.append(reachability_map.is_move_reachable)
+    return move_filters
 
 
 #verify if a position is reachable from an arm positioned at arm_position
 def verify_pose(arm_position, target_position):
-    target_position -= arm_position     # arm base offset
-    target_position += [0.05, 0.05, 0.1]    # target middle of block top face
+    solution = lookup_module_pose(arm_position, np.multiply(target_position, 10))
+    if solution != None:
+        count_event("ik_cache_hits")
+        return solution[0]
+    count_event("ik_solves")
+    return solve_pose(arm_position, target_position)[0]
+
+
+# Solve inverse kinematics for a position (metres) from an arm positioned at arm_position
+# Returns (True if position is reachable, joint angles)
+def solve_pose(arm_position, target_position):
+    target_position = np.asarray(target_position, dtype = float) - arm_position     # arm base offset
+    target_position += MODULE_TARGET_OFFSET    # target middle of block top face
 
     # orientate end-effector downwards
     target_orientation = [0, 0, -1]
     orientation_mode = "Z"
 
     # Get joint angles to place end-effector at target_position at the target_orientation
-    ik = my_chain.inverse_kinematics(target_position, target_orientation, initial_position=HOME_POSITION_ANGLES, orientation_mode=orientation_mode)
+    ik = get_chain().inverse_kinematics(target_position, target_orientation, initial_position=HOME_POSITION_ANGLES, orientation_mode=orientation_mode)
     
     # Verify joint angles with forward kinematics
-    computed_position = my_chain.forward_kinematics(ik)
+    computed_position = get_chain().forward_kinematics(ik)
+
+    # If end-effector within error margin of target position, position is reachable
+    return is_valid_position(computed_position[:3, 3], target_position), ik
+
+
+# Solve inverse kinematics for a module grid position (decimetres) from an arm positioned at arm_position
+def solve_module_pose(arm_position, position):
+    return solve_pose(arm_position, np.divide(position, 10))
+
+
+# Return every distinct module grid position moved from or to in a transition path
+def get_movement_positions(transition_path):
+    positions = []
+    for state in transition_path:
+        if (state.birth_movement != 0):
+            for pos in state.birth_movement:
+                positions.append(tuple(int(x) for x in pos))
+    return list(dict.fromkeys(positions))
+
 
-    # If end-effector within error margin of target position, return true
-    if is_valid_position(computed_position[:3, 3], target_position):
-        return True
+# Solve inverse kinematics for a batch of module grid positions (decimetres)
+# Positions covered by the active reachability map are looked up, duplicate positions are solved once,
+# in worker processes if workers > 1
+# Returns dictionary of position -> (True if position is reachable, joint angles)
+def solve_ik_batch(arm_position, positions, workers = 1):
+    num_positions = len(positions)
+    positions = list(dict.fromkeys([tuple(int(x) for x in pos) for pos in positions]))
+    count_event("ik_cache_hits", num_positions - len(positions))     # duplicate positions solved once
+    
+    ik_solutions = dict()
+    unsolved_positions = []
+    for pos in positions:
+        solution = lookup_module_pose(arm_position, pos)
+        if solution != None:
+            ik_solutions[pos] = solution
+            count_event("ik_cache_hits")
+        else:
+            unsolved_positions.append(pos)
+    
+    arm_positions = [arm_position] * len(unsolved_positions)
+    count_event("ik_solves", len(unsolved_positions))
+    if workers > 1 and len(unsolved_positions) > 1:
+        with ProcessPoolExecutor(max_workers = workers) as executor:
+            solutions = list(executor.map(solve_module_pose, arm_positions, unsolved_positions))
     else:
-        return False
+        solutions = list(map(solve_module_pose, arm_positions, unsolved_positions))
+    ik_solutions.update(zip(unsolved_positions, solutions))
+    return ik_solutions
 
 
 # Get joint angles to place end-effector at target_position orientated downwards
 def get_ik(target_position):
+    # use active reachability map if the target is the top face of a module grid position
+    if active_reachability_map != None:
+        arm_position = active_reachability_map.arm_position
+        position = (np.asarray(target_position) - MODULE_TARGET_OFFSET + arm_position) * 10
+        solution = lookup_module_pose(arm_position, position)
+        if solution != None:
+            count_event("ik_cache_hits")
+            return np.array(solution[1])
+    count_event("ik_solves")
+    
     # point down
     target_orientation = [0, 0, -1]
     orientation_mode = "Z"
 
     # Get joint angles
-    return my_chain.inverse_kinematics(target_position, target_orientation, initial_position=HOME_POSITION_ANGLES, orientation_mode=orientation_mode)
+    return get_chain().inverse_kinematics(target_position, target_orientation, initial_position=HOME_POSITION_ANGLES, orientation_mode=orientation_mode)
 
 
 # Return true if position is within error range of target position, else False
@@ -61,10 +187,13 @@ def is_valid_position(position, target_position):
 
 # Display mobile manipulator pose
 def display_pose(inverse_kinematics, target_position):
+    import ikpy.utils.plot as plot_utils
+    import matplotlib.pyplot as plt
+    
     fig, ax = plot_utils.init_3d_figure()
     fig.set_figheight(9)  
     fig.set_figwidth(13)  
-    my_chain.plot(inverse_kinematics, ax, target=target_position)
+    get_chain().plot(inverse_kinematics, ax, target=target_position)
     plt.xlim(-0.5, 0.5)
     plt.ylim(-0.5, 0.5)
     ax.set_zlim(0, 0.6)
@@ -73,13 +202,15 @@ def display_pose(inverse_kinematics, target_position):
     
 
 # Verify transition path movements adhere to physical constraints
-# If they do, Return list of instructions for the mobile manipulator
-def motion_planner(transition_path):
+# If they do, Return (list of instructions for the mobile manipulator, 0), else (0, PhysicalFailure)
+# ik_solutions from solve_ik_batch are reused for joint angles instead of solving again
+def motion_planner(transition_path, ik_solutions = None):
     # confirm all movements possible
     for state in transition_path:
         if (state.birth_movement != 0):
-            if not movement_possible(state):
-                return 0, state
+            failure = get_movement_failure(state)
+            if failure != 0:
+                return 0, failure
     
     
     # develop movement plan
@@ -90,10 +221,10 @@ def motion_planner(transition_path):
     instruction_set = [["START"]]
     for state in transition_path:
         if (state.birth_movement != 0):
-            instruction_set.append(generate_move_inst(state.birth_movement[0]))
+            instruction_set.append(generate_move_inst(state.birth_movement[0], ik_solutions))
             instruction_set.append(["CONNECT"])
             
-            instruction_set.append(generate_move_inst(state.birth_movement[1]))
+            instruction_set.append(generate_move_inst(state.birth_movement[1], ik_solutions))
             instruction_set.append(["DISCONNECT"])
     instruction_set.append(["END"])
     
@@ -101,29 +232,41 @@ def motion_planner(transition_path):
     
 
 # Return move to instruction for position
-def generate_move_inst(position):
+# Joint angles are taken from ik_solutions if the position has been solved
+def generate_move_inst(position, ik_solutions = None):
     # correct module position to top face of module
     target_position = np.asarray(position) + [0.05, 0.05, 0.1]
+    
+    key = tuple(int(x) for x in position)
+    if ik_solutions != None and key in ik_solutions:
+        count_event("ik_cache_hits")
+        return ["MOVE_TO", tuple(target_position), tuple(ik_solutions[key][1])]
     return ["MOVE_TO", tuple(target_position), tuple(get_ik(target_position))]
     
 
 # Verify movement adheres to physical constraints
 def movement_possible(state):
+    return get_movement_failure(state) == 0
+
+
+# Return PhysicalFailure describing why the movement creating a state is not possible, or 0 if possible
+def get_movement_failure(state):
     movement = state.birth_movement
-    # verify module can be lifted (no blocks above module)
+    # verify module can be lifted (no blocks above module, other than the moved module)
     for key in state.get_module_positions():
         if (key[0] == movement[0][0]) and (key[1] == movement[0][1]) and (key[2] > movement[0][2]):
-            return False
+            if not np.array_equal(key, movement[1]):
+                return PhysicalFailure(state, BLOCKED_LIFT, movement[0])
     
     # verify module placement is above surface
     if movement[1][2] < 0:
-        return False
+        return PhysicalFailure(state, BELOW_SURFACE, movement[1])
     
     # verify module placement is supported position
     # (a surface exists directly below placement position)
     supporting_position = tuple(movement[1] - [0,0,1])
     if (movement[1][2] != 0):
         if not (supporting_position in state.get_module_positions()):
-            return False
+            return PhysicalFailure(state, UNSUPPORTED_PLACEMENT, movement[1])
         
-    return True
\ No newline at end of file
+    return 0
\ No newline at end of file
@@ -0,0 +1,157 @@
+import os
+import math
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .physical_layer import get_chain, solve_module_pose, use_reachability_map
+from .physical_layer import URDF_FILE, HOME_POSITION_ANGLES, END_POSITION_ERROR_MARGIN
+
+
+# This physical layer file details a precomputed reachability map of the module grid around a
+# stationary arm, so inverse kinematics is solved once per grid position and then looked up from
+# memory-mapped files shared by every planning run and worker process
+
+
+REACHABILITY_MAP_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "reachability_maps")
+REACHABILITY_MAP_FORMAT_VERSION = 1
+GRID_CELL_SIZE = 0.1      # module grid positions are in decimetres
+
+
+# A grid of inverse kinematics solutions for module positions around an arm position
+# reachable[index] is True if the module position is reachable, joints[index] holds the solved joint angles
+# Maps loaded from a directory are pickled by reference, so worker processes memory-map the same files
+class ReachabilityMap:
+    def __init__(self, arm_position, origin, reachable, joints, directory = None):
+        self.arm_position = np.asarray(arm_position, dtype = float)
+        self.origin = np.asarray(origin, dtype = int)
+        self.reachable = reachable
+        self.joints = joints
+        self.directory = directory
+
+
+    def __reduce__(self):
+        if self.directory != None:
+            return (load_reachability_map, (self.arm_position.tolist(), self.directory))
+        return (ReachabilityMap, (self.arm_position, self.origin, np.asarray(self.reachable), np.asarray(self.joints)))
+
+
+    # Return map index of a module grid position, or None if the position is outside the map
+    def get_index(self, position):
+        index = np.asarray(position, dtype = int) - self.origin
+        if np.any(index < 0) or np.any(index >= self.reachable.shape):
+            return None
+        return tuple(index)
+
+
+    # Return True if a module grid position is reachable, positions outside the map are unreachable
+    def is_reachable(self, position):
+        index = self.get_index(position)
+        return index != None and bool(self.reachable[index])
+
+
+    # Return (True if reachable, joint angles) for a module grid position, or None if outside the map
+    def get_solution(self, position):
+        index = self.get_index(position)
+        if index == None:
+            return None
+        return bool(self.reachable[index]), np.array(self.joints[index])
+
+
+    # Move filter allowing moves where the arm reaches both the lifted module and its placement
+    def is_move_reachable(self, state, module_pos, move_pos):
+        return self.is_reachable(module_pos) and self.is_reachable(move_pos)
+
+
+# Return maximum arm reach (metres) as the sum of the chain link lengths
+def get_arm_reach():
+    return sum(np.linalg.norm(link.origin_translation) for link in get_chain().links
+               if getattr(link, "origin_translation", None) is not None)
+
+
+# Return key identifying the arm model, arm position and solver settings a map was built for
+def get_reachability_map_key(arm_position):
+    key = hashlib.sha256()
+    with open(URDF_FILE, "rb") as urdf_file:
+        key.update(urdf_file.read())
+    key.update(repr((REACHABILITY_MAP_FORMAT_VERSION, [float(x) for x in arm_position],
+                     HOME_POSITION_ANGLES, END_POSITION_ERROR_MARGIN)).encode())
+    return key.hexdigest()[:16]
+
+
+# Return file paths of the reachability map arrays for an arm position
+def get_reachability_map_files(arm_position, directory = REACHABILITY_MAP_DIRECTORY):
+    key = get_reachability_map_key(arm_position)
+    return {name: os.path.join(directory, key + "_" + name + ".npy") for name in ["origin", "reachable", "joints"]}
+
+
+# Build reachability map by solving inverse kinematics for every grid position within arm reach
+# Positions beyond the arm reach are marked unreachable without solving
+def build_reachability_map(arm_position, workers = 1):
+    arm_cell = np.floor(np.asarray(arm_position, dtype = float) / GRID_CELL_SIZE).astype(int)
+    radius = math.ceil(get_arm_reach() / GRID_CELL_SIZE) + 1
+    origin = arm_cell - radius
+    shape = (2 * radius + 1,) * 3
+
+    reachable = np.zeros(shape, dtype = bool)
+    joints = np.zeros(shape + (len(get_chain().links),), dtype = float)
+
+    # only solve cells whose module top face lies within arm reach
+    indexes = np.argwhere(np.ones(shape, dtype = bool))
+    positions = indexes + origin
+    distances = np.linalg.norm((positions + 0.5) * GRID_CELL_SIZE - arm_position, axis = 1)
+    in_reach = distances <= get_arm_reach() + GRID_CELL_SIZE
+    positions = [tuple(pos) for pos in positions[in_reach].tolist()]
+    arm_positions = [arm_position] * len(positions)
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers = workers) as executor:
+            solutions = list(executor.map(solve_module_pose, arm_positions, positions, chunksize = 64))
+    else:
+        solutions = list(map(solve_module_pose, arm_positions, positions))
+
+    for index, (valid, ik) in zip(indexes[in_reach], solutions):
+        reachable[tuple(index)] = valid
+        joints[tuple(index)] = ik
+    return ReachabilityMap(arm_position, origin, reachable, joints)
+
+
+# Save reachability map arrays, each file is written to a temporary file then moved into place
+def save_reachability_map(reachability_map, directory = REACHABILITY_MAP_DIRECTORY):
+    os.makedirs(directory, exist_ok = True)
+    files = get_reachability_map_files(reachability_map.arm_position, directory)
+    arrays = {"origin": reachability_map.origin, "reachable": reachability_map.reachable,
+              "joints": reachability_map.joints}
+
+    # origin is written last so a partially written map is never loaded
+    for name in ["reachable", "joints", "origin"]:
+        temp_file = files[name] + "." + str(os.getpid()) + ".tmp"
+        with open(temp_file, "wb") as array_file:
+            np.save(array_file, np.asarray(arrays[name]))
+        os.replace(temp_file, files[name])
+
+
+# Load memory-mapped reachability map for an arm position, or None if no map has been saved
+def load_reachability_map(arm_position, directory = REACHABILITY_MAP_DIRECTORY):
+    files = get_reachability_map_files(arm_position, directory)
+    if not all(os.path.exists(path) for path in files.values()):
+        return None
+
+    origin = np.load(files["origin"])
+    reachable = np.load(files["reachable"], mmap_mode = "r")
+    joints = np.load(files["joints"], mmap_mode = "r")
+    return ReachabilityMap(arm_position, origin, reachable, joints, directory)
+
+
+# Load the reachability map for an arm position, building and saving it if build is True and none exists
+# The map is made active so pose verification and instruction generation use it
+def get_reachability_map(arm_position, workers = 1, build = True, directory = REACHABILITY_MAP_DIRECTORY):
+    reachability_map = load_reachability_map(arm_position, directory)
+    if reachability_map == None and build:
+        print("Building reachability map for arm position", list(arm_position))
+        save_reachability_map(build_reachability_map(arm_position, workers), directory)
+        reachability_map = load_reachability_map(arm_position, directory)
+
+    use_reachability_map(reachability_map)
+    return reachability_map
@@ -0,0 +1,172 @@
+import os
+import shutil
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from logic_layer.task_planner import create_colour_table, module_type_registry
+
+
+# This program details the rendering of reconfiguration videos from transition paths
+# Colour masks of every frame are computed in one pass, frames are rendered to PNG files in worker
+# processes as they are needed and the video (HTML player, GIF or image sequence) is assembled afterwards
+
+
+VIDEO_SAVE_LOCATION = os.path.join(os.path.dirname(os.path.abspath(__file__)), "videos")
+VIDEO_FRAME_INTERVAL = 1000     # ms
+VIDEO_FRAME_DIRECTORY = "video_frames"
+VIDEO_TITLE = "Reconfiguration Video"
+
+# Video outputs
+# "html" - HTML player of the frame images
+# "gif"  - animated GIF
+# "png"  - numbered PNG image sequence
+VIDEO_FORMATS = ["html", "gif", "png"]
+DEFAULT_VIDEO_FORMAT = "html"
+
+HTML_PLAYER_TEMPLATE = """<html>
+<head><title>{title}</title></head>
+<body>
+<img id="frame" src="{first_frame}">
+<br>
+<button onclick="step(-1)">&lt;</button>
+<button onclick="toggle()">Play / Pause</button>
+<button onclick="step(1)">&gt;</button>
+<input id="slider" type="range" min="0" max="{last_index}" value="0" oninput="show(parseInt(this.value))">
+<script>
+var frames = [{frames}];
+var index = 0;
+var timer = null;
+function show(i) {{
+  index = (i + frames.length) % frames.length;
+  document.getElementById("frame").src = frames[index];
+  document.getElementById("slider").value = index;
+}}
+function step(d) {{ show(index + d); }}
+function toggle() {{
+  if (timer) {{ clearInterval(timer); timer = null; }}
+  else {{ timer = setInterval(function() {{ step(1); }}, {interval}); }}
+}}
+toggle();
+</script>
+</body>
+</html>
+"""
+
+
+# Return the RGBA colour masks of every state in a transition path as one (frames, x, y, z, 4) array
+# Every frame shares the grid of the whole path, so modules keep their place between frames
+# Empty positions have zero alpha
+def create_colour_masks(transition_path):
+    frame_indexes = []
+    positions = []
+    type_ids = []
+    for frame, state in enumerate(transition_path):
+        state_positions = state.get_position_array()
+        frame_indexes += [frame] * len(state_positions)
+        positions.append(state_positions)
+        type_ids += [module.get_type_id() for module in state.get_modules()]
+
+    positions = np.concatenate(positions + [np.zeros((0, 3), dtype = int)])
+    positions -= np.minimum(positions.min(axis = 0, initial = 0), 0)     # move negative positions into positive space
+    size = positions.max(initial = 0) + 1
+
+    colour_masks = np.zeros((len(transition_path), size, size, size, 4))
+    index = (np.asarray(frame_indexes, dtype = int),) + tuple(positions.T)
+    colour_masks[index] = create_colour_table(module_type_registry)[np.asarray(type_ids, dtype = int)]
+    return colour_masks
+
+
+# Render a colour mask to a PNG file
+# A pyplot-free figure is used, so rendering never opens a window or changes the matplotlib backend
+def render_frame(colour_mask, filename, title = VIDEO_TITLE):
+    from matplotlib.figure import Figure
+
+    fig = Figure()
+    ax = fig.add_subplot(projection = '3d')
+    ax.set_title(title)
+    ax.axis("off")
+    ax.voxels(colour_mask[..., 3] > 0,
+              facecolors = colour_mask,
+              edgecolors = 'k',
+              linewidth = 0.5)
+    fig.savefig(filename)
+    return filename
+
+
+# Return file name of a numbered frame image
+def get_frame_filename(directory, frame):
+    return os.path.join(directory, "frame" + str(frame).zfill(7) + ".png")
+
+
+# Render every colour mask to a numbered PNG file in directory, in worker processes if workers > 1
+# Frames are written to disk as they finish, identical frames are rendered once and copied
+# Returns list of frame file names in frame order
+def render_frames(colour_masks, directory, workers = 1):
+    os.makedirs(directory, exist_ok = True)
+    filenames = [get_frame_filename(directory, frame) for frame in range(len(colour_masks))]
+
+    # first frame of each distinct colour mask
+    digests = [hashlib.sha1(colour_mask.tobytes()).hexdigest() for colour_mask in colour_masks]
+    first_frames = dict()
+    for frame, digest in enumerate(digests):
+        first_frames.setdefault(digest, frame)
+
+    unique_frames = sorted(first_frames.values())
+    if workers > 1 and len(unique_frames) > 1:
+        with ProcessPoolExecutor(max_workers = workers) as executor:
+            futures = [executor.submit(render_frame, colour_masks[frame], filenames[frame]) for frame in unique_frames]
+            for future in as_completed(futures):
+                future.result()
+    else:
+        for frame in unique_frames:
+            render_frame(colour_masks[frame], filenames[frame])
+
+    for frame, digest in enumerate(digests):
+        if first_frames[digest] != frame:
+            shutil.copyfile(filenames[first_frames[digest]], filenames[frame])
+    return filenames
+
+
+# Write an HTML player of frame images, frames are referenced relative to the player file
+def assemble_html(filenames, output_filename, title = VIDEO_TITLE, interval = VIDEO_FRAME_INTERVAL):
+    output_directory = os.path.dirname(output_filename)
+    frames = [os.path.relpath(filename, output_directory).replace(os.sep, "/") for filename in filenames]
+    with open(output_filename, "w") as output_file:
+        output_file.write(HTML_PLAYER_TEMPLATE.format(title = title, first_frame = frames[0],
+                                                      last_index = len(frames) - 1, interval = interval,
+                                                      frames = ", ".join(['"' + frame + '"' for frame in frames])))
+
+
+# Write an animated GIF of frame images
+def assemble_gif(filenames, output_filename, interval = VIDEO_FRAME_INTERVAL):
+    from PIL import Image
+
+    images = [Image.open(filename) for filename in filenames]
+    images[0].save(output_filename, save_all = True, append_images = images[1:], duration = interval, loop = 0)
+    for image in images:
+        image.close()
+
+
+# Create and save a video of a transition path in directory/label
+# video_format is one of VIDEO_FORMATS, frames are rendered in worker processes if workers > 1
+# Returns the video file name, or the frame directory of an image sequence
+def create_reconfiguration_video(transition_path, label = "temp", video_format = DEFAULT_VIDEO_FORMAT,
+                                 workers = 1, directory = VIDEO_SAVE_LOCATION):
+    if video_format not in VIDEO_FORMATS:
+        raise ValueError("Unknown video format: " + str(video_format))
+
+    video_directory = os.path.join(directory, label)
+    frame_directory = os.path.join(video_directory, VIDEO_FRAME_DIRECTORY)
+    filenames = render_frames(create_colour_masks(transition_path), frame_directory, workers)
+
+    if video_format == "html":
+        output_filename = os.path.join(video_directory, "video.html")
+        assemble_html(filenames, output_filename, label)
+        return output_filename
+    if video_format == "gif":
+        output_filename = os.path.join(video_directory, "video.gif")
+        assemble_gif(filenames, output_filename)
+        return output_filename
+    return frame_directory